@@ -0,0 +1,100 @@
+import numpy as np
+
+# rows per chunk are picked so that a chunk holds about this many bytes
+CHUNK_BYTES = 32 * 1024 * 1024
+
+
+class ChunkedArray(object):
+    """Array-like storage allocated in fixed-size chunks on first write.
+
+    A row index maps to its chunk and offset with a shift and a mask, and a
+    batched read gathers from each chunk the batch touches with one fancy
+    index. Rows of chunks never written read as zeros.
+    """
+
+    def __init__(self, shape, dtype, chunk_bytes=CHUNK_BYTES):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.row_shape = self.shape[1:]
+        row_bytes = max(1, int(np.prod(self.row_shape)) * self.dtype.itemsize)
+        self.shift = 0
+        while (
+            2 ** (self.shift + 1) * row_bytes <= chunk_bytes
+            and 2**self.shift < self.shape[0]
+        ):
+            self.shift += 1
+        self.chunk_size = 2**self.shift
+        self.mask = self.chunk_size - 1
+        self.chunks = [None] * -(-self.shape[0] // self.chunk_size)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        """Bytes actually allocated."""
+        return sum(chunk.nbytes for chunk in self.chunks if chunk is not None)
+
+    def _chunk(self, i):
+        if self.chunks[i] is None:
+            self.chunks[i] = np.empty(
+                (self.chunk_size, *self.row_shape), dtype=self.dtype
+            )
+        return self.chunks[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            chunk = self.chunks[idx >> self.shift]
+            if chunk is None:
+                return np.zeros(self.row_shape, dtype=self.dtype)
+            return chunk[idx & self.mask]
+        if isinstance(idx, slice):
+            idx = np.arange(*idx.indices(len(self)))
+        idx = np.asarray(idx)
+        flat = idx.reshape(-1)
+        chunk_ids = flat >> self.shift
+        offsets = flat & self.mask
+        out = np.empty((len(flat), *self.row_shape), dtype=self.dtype)
+
+        order = np.argsort(chunk_ids, kind="stable")
+        sorted_ids = chunk_ids[order]
+        bounds = np.flatnonzero(np.diff(sorted_ids)) + 1
+        if len(bounds) >= len(flat) // 2:
+            # mostly one row per chunk (large rows): copy row by row
+            for j, (i, offset) in enumerate(zip(chunk_ids.tolist(), offsets.tolist())):
+                chunk = self.chunks[i]
+                out[j] = 0 if chunk is None else chunk[offset]
+            return out.reshape(*idx.shape, *self.row_shape)
+
+        # one gather per chunk touched by the batch
+        for rows in np.split(order, bounds):
+            if len(rows) == 0:
+                continue
+            chunk = self.chunks[chunk_ids[rows[0]]]
+            if chunk is None:
+                out[rows] = 0
+            else:
+                out[rows] = chunk[offsets[rows]]
+        return out.reshape(*idx.shape, *self.row_shape)
+
+    def __setitem__(self, idx, value):
+        if isinstance(idx, (int, np.integer)):
+            self._chunk(idx >> self.shift)[idx & self.mask] = value
+            return
+        if not isinstance(idx, slice):
+            # scattered rows, e.g. per-slot caches: one row at a time
+            idx = np.asarray(idx).reshape(-1)
+            value = np.broadcast_to(value, (len(idx), *self.row_shape))
+            for row, i in zip(value, idx.tolist()):
+                self._chunk(i >> self.shift)[i & self.mask] = row
+            return
+        start, end, step = idx.indices(len(self))
+        assert step == 1
+        value = np.broadcast_to(value, (end - start, *self.row_shape))
+        while start < end:
+            i = start >> self.shift
+            offset = start & self.mask
+            n = min(end - start, self.chunk_size - offset)
+            self._chunk(i)[offset : offset + n] = value[:n]
+            value = value[n:]
+            start += n
@@ -0,0 +1,142 @@
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+# batches at least this large are encoded / decoded in chunks on the pool
+THREADED_MIN_BATCH = 32
+
+
+class CompressedFrames(object):
+    """Array-like store of individually, losslessly compressed frames.
+
+    Supports the indexing the replay buffer uses: reading an int, a slice or
+    an index array returns decoded frames, and assigning to an int or a slice
+    compresses them. zlib and lz4 release the GIL, so large batches are
+    decoded in parallel on a thread pool.
+    """
+
+    def __init__(self, shape, dtype, codec="zlib", num_threads=0):
+        assert codec in ("zlib", "lz4"), "invalid frame codec"
+        assert codec != "lz4" or lz4 is not None, "lz4 is not installed"
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.codec = codec
+        self.frame_shape = self.shape[1:]
+        self.frames = [None] * self.shape[0]
+        self.nbytes = 0
+        self.num_threads = num_threads
+        self.pool = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _encode(self, frame):
+        frame = np.ascontiguousarray(frame, dtype=self.dtype)
+        if self.codec == "lz4":
+            return lz4.compress(frame)
+        return zlib.compress(frame, 1)
+
+    def _decode(self, data, out):
+        if data is None:
+            # never written, like the uninitialized slots of np.empty
+            out[...] = 0
+            return
+        data = lz4.decompress(data) if self.codec == "lz4" else zlib.decompress(data)
+        out[...] = np.frombuffer(data, dtype=self.dtype).reshape(self.frame_shape)
+
+    def _store(self, i, data):
+        old = self.frames[i]
+        self.nbytes += len(data) - (0 if old is None else len(old))
+        self.frames[i] = data
+
+    def _map(self, func, n):
+        if self.pool is None or n < THREADED_MIN_BATCH:
+            func(0, n)
+            return
+        bounds = np.linspace(0, n, self.num_threads + 1).astype(int)
+        for future in [
+            self.pool.submit(func, start, end)
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]:
+            future.result()
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            out = np.empty(self.frame_shape, dtype=self.dtype)
+            self._decode(self.frames[idx], out)
+            return out
+        if isinstance(idx, slice):
+            idx = np.arange(*idx.indices(len(self)))
+        idx = np.asarray(idx).reshape(-1)
+        out = np.empty((len(idx), *self.frame_shape), dtype=self.dtype)
+
+        def decode(start, end):
+            for j in range(start, end):
+                self._decode(self.frames[idx[j]], out[j])
+
+        self._map(decode, len(idx))
+        return out
+
+    def __setitem__(self, idx, value):
+        if isinstance(idx, (int, np.integer)):
+            self._store(idx, self._encode(value))
+            return
+        assert isinstance(idx, slice), "frames are written by int or slice"
+        idx = np.arange(*idx.indices(len(self)))
+        value = np.broadcast_to(value, (len(idx), *self.frame_shape))
+        encoded = [None] * len(idx)
+
+        def encode(start, end):
+            for j in range(start, end):
+                encoded[j] = self._encode(value[j])
+
+        self._map(encode, len(idx))
+        for i, data in zip(idx, encoded):
+            self._store(i, data)
+
+    def resize(self, size):
+        self.frames.extend([None] * (size - len(self)))
+        self.shape = (size, *self.frame_shape)
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import time
+
+    if len(sys.argv) > 1:
+        # e.g. the obses.npy of a memmap replay buffer
+        frames = np.load(sys.argv[1], mmap_mode="r")[:512]
+        n = len(frames)
+    else:
+        # synthetic stand-in: two 128x128 cameras of smooth shapes
+        n = 512
+        yy, xx = np.mgrid[:128, :128]
+        frames = np.empty((n, 6, 128, 128), dtype=np.uint8)
+        for i in range(n):
+            for c in range(6):
+                frames[i, c] = (xx * (c + 1) + yy * 2 + i) % 256 // 8 * 8
+
+    codecs = ["zlib"] + (["lz4"] if lz4 is not None else [])
+    for codec in codecs:
+        for num_threads in (0, min(4, os.cpu_count())):
+            store = CompressedFrames(frames.shape, np.uint8, codec, num_threads)
+            store[0:n] = frames
+            assert np.array_equal(store[np.arange(n)], frames)
+            idxes = np.random.randint(0, n, 128)
+            time_start = time.time()
+            for _ in range(20):
+                store[idxes]
+            batches_per_sec = 20 / (time.time() - time_start)
+            print(
+                f"{codec:4s} {num_threads} threads | "
+                f"{store.nbytes / n:9.0f} bytes/frame "
+                f"(raw {frames[0].nbytes}, {frames[0].nbytes * n / store.nbytes:.1f}x) | "
+                f"{batches_per_sec:7.1f} decoded batches/sec of 128"
+            )
@@ -1,23 +1,76 @@
 import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+
+# batches at least this large are cropped in chunks on a thread pool
+THREADED_MIN_BATCH = 256
+_POOL = None
+_NUM_THREADS = 0
+
+
+def set_num_threads(num_threads):
+    """Enable the thread-pooled crop path (0 disables it)."""
+    global _POOL, _NUM_THREADS
+    if _POOL is not None:
+        _POOL.shutdown()
+    _NUM_THREADS = num_threads
+    _POOL = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
 
 
 def random_crop(images, output_size=112):
     """
     args:
-    images: np.array shape (B,C,H,W)
+    images: np.array or torch.Tensor shape (B,C,H,W)
     output_size: output size, assuming square images
-    returns: np.array
+    returns: np.array or torch.Tensor
     """
+    if isinstance(images, torch.Tensor):
+        return random_crop_tensor(images, output_size)
     n, c, h, w = images.shape
     crop_max = h - output_size + 1
     w1 = np.random.randint(0, crop_max, n)
     h1 = np.random.randint(0, crop_max, n)
+    if _POOL is None or n < THREADED_MIN_BATCH:
+        return _gather_crops(images, h1, w1, output_size)
+
+    # numpy releases the GIL while copying, so chunks crop in parallel
     cropped = np.empty((n, c, output_size, output_size), dtype=images.dtype)
-    for i, (image, w11, h11) in enumerate(zip(images, w1, h1)):
-        cropped[i] = image[:, h11 : h11 + output_size, w11 : w11 + output_size]
+    bounds = np.linspace(0, n, _NUM_THREADS + 1).astype(int)
+
+    def crop_chunk(start, end):
+        cropped[start:end] = _gather_crops(
+            images[start:end], h1[start:end], w1[start:end], output_size
+        )
+
+    for future in [
+        _POOL.submit(crop_chunk, start, end)
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ]:
+        future.result()
     return cropped
 
 
+def _gather_crops(images, h1, w1, output_size):
+    # (B, C, H', W', out, out) strided view of every crop window, no copy
+    windows = sliding_window_view(images, (output_size, output_size), axis=(2, 3))
+    return windows[np.arange(len(images)), :, h1, w1]
+
+
+def random_crop_tensor(images, output_size=112):
+    """Random crop gathered with advanced indexing on the images' device."""
+    n, c, h, w = images.shape
+    crop_max = h - output_size + 1
+    w1 = torch.randint(0, crop_max, (n,), device=images.device)
+    h1 = torch.randint(0, crop_max, (n,), device=images.device)
+    offsets = torch.arange(output_size, device=images.device)
+    rows = (h1[:, None] + offsets)[:, None, :, None]
+    cols = (w1[:, None] + offsets)[:, None, None, :]
+    batch = torch.arange(n, device=images.device)[:, None, None, None]
+    channels = torch.arange(c, device=images.device)[None, :, None, None]
+    return images[batch, channels, rows, cols]
+
+
 def center_crop(image, output_size=112):
     h, w = image.shape[1:]
     assert h >= output_size
@@ -31,12 +84,57 @@ def center_crop(image, output_size=112):
 
 
 def batch_center_crop(images, output_size=112):
+    """Center crop of a (B,C,H,W) batch, returned as a view."""
     n, c, h, w = images.shape
-    cropped = np.empty((n, c, output_size, output_size), dtype=images.dtype)
-    for i, image in enumerate(images):
-        cropped[i] = center_crop(image, output_size)
-    return cropped
+    assert h >= output_size
+    top = (h - output_size) // 2
+    left = (w - output_size) // 2
+    return images[:, :, top : top + output_size, left : left + output_size]
 
 
 def no_aug(x):
     return x
+
+
+if __name__ == "__main__":
+    import os
+    import time
+
+    def loop_random_crop(images, output_size=112):
+        n, c, h, w = images.shape
+        crop_max = h - output_size + 1
+        w1 = np.random.randint(0, crop_max, n)
+        h1 = np.random.randint(0, crop_max, n)
+        cropped = np.empty((n, c, output_size, output_size), dtype=images.dtype)
+        for i, (image, w11, h11) in enumerate(zip(images, w1, h1)):
+            cropped[i] = image[:, h11 : h11 + output_size, w11 : w11 + output_size]
+        return cropped
+
+    def loop_center_crop(images, output_size=112):
+        cropped = np.empty(images.shape[:2] + (output_size, output_size), images.dtype)
+        for i, image in enumerate(images):
+            cropped[i] = center_crop(image, output_size)
+        return cropped
+
+    def bench(func, images, repeats=10):
+        func(images)
+        time_start = time.time()
+        for _ in range(repeats):
+            func(images)
+        return (time.time() - time_start) / repeats * 1000
+
+    num_threads = min(4, os.cpu_count())
+    for batch_size in (128, 256, 512, 1024):
+        images = np.random.randint(0, 256, (batch_size, 6, 128, 128), dtype=np.uint8)
+        set_num_threads(0)
+        loop_ms = bench(loop_random_crop, images)
+        vec_ms = bench(random_crop, images)
+        set_num_threads(num_threads)
+        thread_ms = bench(random_crop, images)
+        center_loop_ms = bench(loop_center_crop, images)
+        center_view_ms = bench(batch_center_crop, images)
+        print(
+            f"B={batch_size:5d} | random crop loop {loop_ms:7.2f} ms, "
+            f"vectorized {vec_ms:7.2f} ms, {num_threads} threads {thread_ms:7.2f} ms "
+            f"| center crop loop {center_loop_ms:7.2f} ms, view {center_view_ms:.4f} ms"
+        )
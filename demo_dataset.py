@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import pickle
+
+import numpy as np
+import torch
+
+# frames.npy holds the frames of every trajectory back to back, a trajectory
+# with T transitions owning T + 1 frames; offsets.npy indexes them
+COLUMNS = ("frames", "actions", "rewards", "not_dones")
+
+
+def is_demo_dataset(path):
+    return os.path.isfile(os.path.join(path, "offsets.npy"))
+
+
+class DemoDataset(object):
+    """Memory-mapped columnar demonstrations, read one trajectory at a time."""
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        for name in COLUMNS:
+            path_ = os.path.join(path, name + ".npy")
+            setattr(self, name, np.load(path_, mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def num_transitions(self, i):
+        return int(self.offsets[i + 1] - self.offsets[i] - 1)
+
+    def trajectory(self, i):
+        """Returns (obses, next_obses, actions, rewards, not_dones) of trajectory i.
+
+        Only the pages of this trajectory are read from disk.
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        # transitions are stored without the extra frame of each trajectory
+        t_start, t_end = start - i, end - i - 1
+        frames = self.frames[start:end]
+        return (
+            frames[:-1],
+            frames[1:],
+            self.actions[t_start:t_end],
+            self.rewards[t_start:t_end],
+            self.not_dones[t_start:t_end],
+        )
+
+
+class _Writer(object):
+    def __init__(self, path, num_trajectories, num_frames, frame, action):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        num_transitions = num_frames - num_trajectories
+        shapes = {
+            "frames": ((num_frames, *frame.shape), frame.dtype),
+            "actions": ((num_transitions, *action.shape), np.float32),
+            "rewards": ((num_transitions, 1), np.float32),
+            "not_dones": ((num_transitions, 1), bool),
+        }
+        self.columns = {
+            name: np.lib.format.open_memmap(
+                os.path.join(path, name + ".npy"), mode="w+", dtype=dtype, shape=shape
+            )
+            for name, (shape, dtype) in shapes.items()
+        }
+        self.offsets = [0]
+
+    def write(self, frames, actions, rewards, not_dones):
+        start = self.offsets[-1]
+        i = len(self.offsets) - 1
+        self.columns["frames"][start : start + len(frames)] = frames
+        for name, column in (
+            ("actions", actions),
+            ("rewards", rewards),
+            ("not_dones", not_dones),
+        ):
+            self.columns[name][start - i : start - i + len(column)] = column
+        self.offsets.append(start + len(frames))
+
+    def close(self):
+        for column in self.columns.values():
+            column.flush()
+        np.save(os.path.join(self.path, "offsets.npy"), np.array(self.offsets))
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"num_trajectories": len(self.offsets) - 1}, f)
+
+
+def _stack_rgb(obs_list):
+    td = torch.stack(obs_list)
+    return torch.cat([td[k] for k in td.keys() if k.startswith("rgb")], dim=1).numpy()
+
+
+def convert_modem_dataset(path, out_path):
+    """Converts a pickled modem dataset (list of trajectory dicts)."""
+    with open(path, "rb") as f:
+        trajectories = pickle.load(f)
+
+    first = _stack_rgb(trajectories[0]["next_observations"][:1])
+    num_frames = sum(len(traj["next_observations"]) for traj in trajectories)
+    writer = _Writer(
+        out_path,
+        len(trajectories),
+        num_frames,
+        first[0],
+        trajectories[0]["actions"][0].numpy(),
+    )
+    for traj in trajectories:
+        frames = _stack_rgb(traj["next_observations"])
+        n = len(frames) - 1
+        writer.write(
+            frames,
+            torch.stack(traj["actions"][1:]).numpy(),
+            torch.stack(traj["rewards"][1:]).unsqueeze(1).numpy(),
+            [[True]] * (n - 1) + [[False]],
+        )
+    writer.close()
+
+
+def convert_buffer_chunks(save_dir, out_path):
+    """Converts the .pt chunks read by ReplayBuffer.load, split at demo_ends."""
+    chunks = [c for c in os.listdir(save_dir) if c[-3:] == ".pt"]
+    chunks = sorted(chunks, key=lambda x: int(x.split("_")[0]))
+    demo_starts = np.load(os.path.join(save_dir, "demo_starts.npy"))
+    demo_ends = np.load(os.path.join(save_dir, "demo_ends.npy"))
+    assert demo_starts[0] == 0 and np.all(demo_starts[1:] == demo_ends[:-1])
+
+    writer = None
+    pending = None
+    for chunk in chunks:
+        payload = torch.load(os.path.join(save_dir, chunk))
+        if writer is None:
+            writer = _Writer(
+                out_path,
+                len(demo_ends),
+                int(demo_ends[-1]) + len(demo_ends),
+                np.asarray(payload[0][0]),
+                np.asarray(payload[2][0]),
+            )
+        pending = (
+            payload
+            if pending is None
+            else [np.concatenate([a, b]) for a, b in zip(pending, payload)]
+        )
+        # write every trajectory that is complete in what has been read so far
+        written = writer.offsets[-1] - (len(writer.offsets) - 1)
+        while (
+            len(writer.offsets) - 1 < len(demo_ends)
+            and demo_ends[len(writer.offsets) - 1] - written <= len(pending[0])
+        ):
+            n = int(demo_ends[len(writer.offsets) - 1] - written)
+            obses, next_obses, actions, rewards, not_dones = [p[:n] for p in pending]
+            writer.write(
+                np.concatenate([obses, next_obses[-1:]]), actions, rewards, not_dones
+            )
+            pending = [p[n:] for p in pending]
+            written += n
+    writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True, help="modem .pkl or .pt chunk dir")
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.input):
+        convert_buffer_chunks(args.input, args.output)
+    else:
+        convert_modem_dataset(args.input, args.output)
+    print("Converted {} trajectories.".format(len(DemoDataset(args.output))))
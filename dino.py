@@ -0,0 +1,291 @@
+import threading
+import time
+import weakref
+
+import torch
+import torch.nn as nn
+
+# Load the DINOv2 model only once
+DINO = None
+# seconds load_dino took
+LOAD_TIME = None
+HUB_REPO = "facebookresearch/dinov2"
+MODEL_NAME = "dinov2_vits14_reg"
+# size of the embedding of one camera image by dinov2_vits14_reg
+EMBED_DIM = 384
+# inference precision of the frozen backbone, see with_precision
+PRECISIONS = ("fp32", "bf16", "int8")
+PRECISION = "fp32"
+# where the backbone is loaded from, see configure
+REPO_DIR = None
+MODEL_PATH = None
+
+
+def configure(precision="fp32", repo_dir=None, model_path=None):
+    """Set how load_dino gets the backbone, before its first call.
+
+    repo_dir: a local clone of facebookresearch/dinov2, instead of fetching
+    the code from GitHub.
+    model_path: a TorchScript backbone exported by `python dino.py --export`,
+    which needs neither the dinov2 code nor the network, or a state dict
+    loaded into the architecture instead of downloading the pretrained
+    weights.
+    """
+    assert precision in PRECISIONS, "invalid DINO precision"
+    global PRECISION, REPO_DIR, MODEL_PATH
+    PRECISION, REPO_DIR, MODEL_PATH = precision, repo_dir, model_path
+
+
+def _load_backbone():
+    if MODEL_PATH is not None:
+        try:
+            return torch.jit.load(MODEL_PATH, map_location="cpu")
+        except RuntimeError:
+            # not TorchScript, a state dict
+            pass
+    pretrained = MODEL_PATH is None
+    if REPO_DIR is None:
+        model = torch.hub.load(HUB_REPO, MODEL_NAME, pretrained=pretrained)
+    else:
+        model = torch.hub.load(
+            REPO_DIR, MODEL_NAME, source="local", pretrained=pretrained
+        )
+    if MODEL_PATH is not None:
+        model.load_state_dict(torch.load(MODEL_PATH, map_location="cpu"))
+    return model
+
+
+def load_dino(device):
+    """The DINOv2 backbone shared by the encoders and agents of the process."""
+    global DINO, LOAD_TIME
+    if DINO is None:
+        time_start = time.time()
+        DINO = with_precision(_load_backbone().to(device), PRECISION)
+        LOAD_TIME = time.time() - time_start
+    return DINO
+
+
+def warm_up(device, num_cameras, image_size, batch_size):
+    """Load the backbone and run it on a batch, so that the first update
+    pays for neither. Returns the seconds of the forward."""
+    model = load_dino(device)
+    obs = torch.zeros(batch_size, 3 * num_cameras, image_size, image_size)
+    time_start = time.time()
+    _embed(model, obs.to(device))
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+    return time.time() - time_start
+
+
+class _Autocast(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, images):
+        with torch.autocast(images.device.type, dtype=torch.bfloat16):
+            return self.model(images).float()
+
+
+def with_precision(model, precision):
+    """The frozen fp32 model, prepared for inference at precision.
+
+    bf16 runs the forward under bf16 autocast. int8 dynamically quantizes
+    the linear layers, which only runs on CPU. The two don't combine, the
+    quantized linear layers take fp32 inputs. Both change the features a
+    little, check that the bonus is preserved with `python dino.py --demos`.
+    """
+    assert precision in PRECISIONS, "invalid DINO precision"
+    if precision == "bf16":
+        return _Autocast(model)
+    if precision == "int8":
+        assert not isinstance(
+            model, torch.jit.ScriptModule
+        ), "int8 quantizes the eager model, not an exported one"
+        assert next(model.parameters()).device.type == "cpu", "int8 DINO is CPU only"
+        return torch.ao.quantization.quantize_dynamic(
+            model, {nn.Linear}, dtype=torch.qint8
+        )
+    return model
+
+
+class DINOFeatureCache(object):
+    """Embeddings of the image batches that are still alive.
+
+    Within one update the actor, critic, critic target and bonus embed the
+    same obs and next_obs tensors. Keyed by model and tensor identity and
+    checked against the tensor version (in-place writes bump it), each batch
+    goes through the backbone once. An entry goes away with its tensor and is
+    replaced when the tensor is refilled, like the slots of BatchPrefetcher,
+    so there is at most one entry per live batch.
+
+    The entries and counts are per thread, so that the updates of
+    AsyncE2CTrainer neither share entries nor count towards the training
+    thread. The weakref callbacks can run on any thread, the entries are
+    only mutated under the lock.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        # reentrant: a collection inside the lock can run a callback
+        self.lock = threading.RLock()
+
+    def _thread_state(self):
+        state = self.local
+        if not hasattr(state, "entries"):
+            state.entries, state.hits, state.misses = {}, 0, 0
+        return state
+
+    def get(self, model, obs, embed):
+        state = self._thread_state()
+        entries = state.entries
+        key = (id(model), id(obs))
+        with self.lock:
+            entry = entries.get(key)
+        if entry is not None and entry[1] == obs._version:
+            state.hits += 1
+            return entry[2]
+        state.misses += 1
+        features = embed(model, obs)
+
+        # dropped when obs is freed, before its id can be reused; an entry of
+        # an older version of obs is overwritten
+        def drop(_):
+            with self.lock:
+                entries.pop(key, None)
+
+        with self.lock:
+            entries[key] = (weakref.ref(obs, drop), obs._version, features)
+        return features
+
+    def pop_counts(self):
+        """(hits, misses) of the calling thread since its last call."""
+        state = self._thread_state()
+        counts = (state.hits, state.misses)
+        state.hits, state.misses = 0, 0
+        return counts
+
+
+FEATURE_CACHE = DINOFeatureCache()
+
+
+def _embed(model, obs):
+    # fold the RGB images of every camera (and stacked frame) into the batch,
+    # so that the backbone runs once for all of them
+    batch_size, channels, height, width = obs.shape
+    images = obs.reshape(batch_size * (channels // 3), 3, height, width)
+    with torch.no_grad():
+        features = model(images)
+    return features.reshape(batch_size, -1)
+
+
+def dino_embed(model, obs):
+    """DINO features of the RGB images stacked in the channels of obs, in
+    channel order, (B, C / 3 * EMBED_DIM). Memoized in FEATURE_CACHE."""
+    return FEATURE_CACHE.get(model, obs, _embed)
+
+
+def _export(path, image_size):
+    # DINOv2 interpolates its position embeddings with python ints, the
+    # trace holds for image_size only
+    model = _load_backbone().eval()
+    example = torch.rand(1, 3, image_size, image_size)
+    with torch.no_grad():
+        torch.jit.trace(model, example).save(path)
+    print(f"Exported {MODEL_NAME} for {image_size}x{image_size} images to {path}")
+
+
+def _benchmark(args):
+    import numpy as np
+
+    from demo_bank import DemoLatentBank
+    from demo_dataset import DemoDataset
+
+    device = torch.device(args.device)
+
+    # the center crops the bonus is computed on
+    dataset = DemoDataset(args.demos)
+    demos = [
+        dataset.trajectory(i)[1][:, :, 8:120, 8:120]
+        for i in range(min(args.n_demos, len(dataset)))
+    ]
+    assert len(demos) > 1, "the nearest-demo check needs two demos"
+    lengths = [len(frames) for frames in demos]
+    frames = torch.as_tensor(np.concatenate(demos))
+    num_images = len(frames) * (frames.shape[1] // 3)
+
+    def embed_demos(model):
+        """Features of every demo frame, and images per second."""
+        _embed(model, frames[: args.batch_size].to(device).float() / 255)
+        time_start = time.time()
+        features = [
+            _embed(model, batch.to(device).float() / 255)
+            for batch in frames.split(args.batch_size)
+        ]
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        return torch.cat(features).float(), num_images / (time.time() - time_start)
+
+    def bonus_decisions(features):
+        """Nearest row, bonus hit and discount power of each demo frame
+        against the other demos, as the LaNE bonus on DINO features sees it."""
+        per_demo = list(features.split(lengths))
+        rows, close, powers = [], [], []
+        for i, queries in enumerate(per_demo):
+            bank = DemoLatentBank(per_demo[:i] + per_demo[i + 1 :])
+            min_dist, power = bank.nearest(queries)
+            rows.append(bank._exact_nearest(queries, (queries**2).sum(dim=1))[1])
+            close.append(min_dist < bank.one_step_dist())
+            powers.append(power)
+        return torch.cat(rows), torch.cat(close), torch.cat(powers)
+
+    model = _load_backbone().to(device)
+    reference, fp32_rate = embed_demos(model)
+    ref_rows, ref_close, ref_powers = bonus_decisions(reference)
+    print(
+        f"{len(demos)} demos, {num_images} images | fp32 {fp32_rate:7.1f} images/s | "
+        f"bonus on {ref_close.float().mean().item():.3f} of the frames"
+    )
+    for precision in PRECISIONS[1:]:
+        if precision == "int8" and (
+            device.type != "cpu" or isinstance(model, torch.jit.ScriptModule)
+        ):
+            continue
+        features, rate = embed_demos(with_precision(model, precision))
+        cosine = torch.nn.functional.cosine_similarity(
+            features.reshape(-1, EMBED_DIM), reference.reshape(-1, EMBED_DIM)
+        )
+        rows, close, powers = bonus_decisions(features)
+        both = close & ref_close
+        print(
+            f"{precision:4s} | {rate:7.1f} images/s ({rate / fp32_rate:.2f}x) | "
+            f"cosine mean {cosine.mean().item():.5f} min {cosine.min().item():.5f} | "
+            f"same nearest demo frame {(rows == ref_rows).float().mean().item():.3f} | "
+            f"same bonus hit {(close == ref_close).float().mean().item():.3f} | "
+            f"same discount power {(powers[both] == ref_powers[both]).float().mean().item():.3f}"
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Export the backbone, or compare the accuracy and throughput "
+        "of the DINO precisions on stored demos"
+    )
+    parser.add_argument("--demos", help="dataset of demo_dataset.py")
+    parser.add_argument("--n_demos", default=10, type=int)
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--export", help="TorchScript file for --dino_model")
+    parser.add_argument("--image_size", default=112, type=int)
+    parser.add_argument("--dino_repo", default=None)
+    parser.add_argument("--dino_model", default=None)
+    args = parser.parse_args()
+    configure(repo_dir=args.dino_repo, model_path=args.dino_model)
+
+    if args.export is not None:
+        _export(args.export, args.image_size)
+    else:
+        assert args.demos is not None, "--demos or --export is required"
+        _benchmark(args)
@@ -0,0 +1,109 @@
+import torch
+
+
+class E2CRefreshScheduler(object):
+    """Decides when and for how long to retrain the E2C model.
+
+    "fixed" retrains every check_interval steps with the full budget, like
+    before. "adaptive" only retrains when one of three cheap drift signals
+    says the latent space is stale:
+
+    - the reconstruction MSE of the current model on recent transitions is
+      above mse_tol, with a budget growing with the excess,
+    - the mean log1p(distance to the nearest demo / reference one-step
+      distance) of sampled next states moved by more than latent_shift_tol
+      since the first window after the last refresh,
+    - the bonus hit rate (num_additional_reward per sample) fell below
+      hit_drop times its value in that window,
+
+    or after max_interval steps without a refresh.
+    """
+
+    def __init__(
+        self,
+        mode,
+        max_updates,
+        mse_tol,
+        check_interval=300,
+        max_interval=3000,
+        min_updates=100,
+        latent_shift_tol=0.5,
+        hit_drop=0.5,
+        window=10000,
+    ):
+        assert mode in ("fixed", "adaptive"), "invalid E2C schedule"
+        self.mode = mode
+        self.max_updates = max_updates
+        self.mse_tol = mse_tol
+        self.check_interval = check_interval
+        self.max_interval = max_interval
+        self.min_updates = min_updates
+        self.latent_shift_tol = latent_shift_tol
+        self.hit_drop = hit_drop
+        # recent transitions the reconstruction MSE is measured on
+        self.window = window
+
+        self.last_refresh = None
+        self.baseline = None
+        self._reset_window()
+
+    def _reset_window(self):
+        # device tensors, so that observing a batch does not sync
+        self.log_dist_sum = 0.0
+        self.hit_sum = 0.0
+        self.num_observed = 0
+
+    def observe(self, min_dist, close, ref_one_step_dist):
+        """Accumulate the nearest demo distances and hits of a batch."""
+        self.log_dist_sum += torch.log1p(min_dist / ref_one_step_dist).mean()
+        self.hit_sum += close.float().mean()
+        self.num_observed += 1
+
+    def refreshed(self, step):
+        """A new model and demo bank are in use from step on."""
+        self.last_refresh = step
+        self.baseline = None
+        self._reset_window()
+
+    def decide(self, step, recon_mse, L):
+        """(num_updates, mse_tol) of the refresh to run at step, num_updates
+        0 for none. recon_mse() measures the model on recent transitions."""
+        if step % self.check_interval != 0:
+            return 0, self.mse_tol
+        if self.mode == "fixed" or self.last_refresh is None:
+            return self.max_updates, self.mse_tol
+
+        mse = recon_mse()
+        latent_shift, hit_rate, hit_ratio = 0.0, 0.0, 1.0
+        if self.num_observed > 0:
+            window = (
+                self.log_dist_sum.item() / self.num_observed,
+                self.hit_sum.item() / self.num_observed,
+            )
+            self._reset_window()
+            if self.baseline is None:
+                self.baseline = window
+            latent_shift = abs(window[0] - self.baseline[0])
+            hit_rate = window[1]
+            if self.baseline[1] > 0:
+                hit_ratio = hit_rate / self.baseline[1]
+
+        num_updates, mse_tol = 0, self.mse_tol
+        if mse > self.mse_tol:
+            # one more tenth of the budget per mse_tol of excess
+            excess = (mse - self.mse_tol) / self.mse_tol
+            num_updates = int(self.max_updates * min(1.0, 0.1 * excess))
+            num_updates = max(self.min_updates, num_updates)
+        elif (
+            latent_shift > self.latent_shift_tol
+            or hit_ratio < self.hit_drop
+            or step - self.last_refresh >= self.max_interval
+        ):
+            # the reconstruction is fine, mse_tol would stop at once
+            num_updates, mse_tol = self.min_updates, None
+
+        L.log("train/e2c_recon_mse", mse, step)
+        L.log("train/e2c_latent_shift", latent_shift, step)
+        L.log("train/e2c_hit_rate", hit_rate, step)
+        L.log("train/e2c_refresh_updates", num_updates, step)
+        return num_updates, mse_tol
@@ -0,0 +1,76 @@
+import copy
+import threading
+
+import torch
+
+
+class AsyncE2CTrainer(object):
+    """Refreshes an agent's E2C model in a background thread.
+
+    A refresh trains a copy of the model with its own optimizer, then encodes
+    the demos with it into a new demo bank. The agent keeps using its current
+    model and bank for the bonus meanwhile and installs the new ones between
+    two SAC updates, see RadSacAgent.install_e2c.
+    """
+
+    def __init__(self, agent, replay_buffer):
+        self.agent = agent
+        self.replay_buffer = replay_buffer
+        self.model = copy.deepcopy(agent.e2c)
+        self.optimizer = torch.optim.Adam(self.model.parameters(), lr=1e-4)
+        self.optimizer.load_state_dict(agent.e2c_optimizer.state_dict())
+        self.device = torch.device(replay_buffer.device)
+        # keep the refresh off the stream of the SAC updates
+        self.stream = torch.cuda.Stream() if self.device.type == "cuda" else None
+
+        self._thread = None
+        self._result = None
+
+    def request(self, L, step, num_updates, mse_tol):
+        """Start a refresh; the previous one must have been collected."""
+        assert self._thread is None, "an E2C refresh is already running"
+        self._result = None
+        self._thread = threading.Thread(
+            target=self._run, args=(L, step, num_updates, mse_tol), daemon=True
+        )
+        self._thread.start()
+
+    def result(self, wait=False):
+        """(state_dict, demo_bank, request step) of the finished refresh, or
+        None if it is still running. demo_bank is None when the model did not
+        change. Raises the error of a failed refresh."""
+        if self._thread is None or (self._thread.is_alive() and not wait):
+            return None
+        self._thread.join()
+        self._thread = None
+        if isinstance(self._result, Exception):
+            raise self._result
+        return self._result
+
+    def _run(self, L, step, num_updates, mse_tol):
+        try:
+            self._result = self._refresh(L, step, num_updates, mse_tol)
+        except Exception as e:
+            self._result = e
+
+    def _refresh(self, L, step, num_updates, mse_tol):
+        if self.stream is not None:
+            # start after the work already queued on the device
+            self.stream.wait_stream(torch.cuda.default_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            num_steps = self.agent.update_e2c(
+                self.replay_buffer,
+                L,
+                step,
+                num_updates,
+                mse_tol=mse_tol,
+                e2c=self.model,
+                e2c_optimizer=self.optimizer,
+            )
+            demo_bank, state_dict = None, None
+            if num_steps > 0:
+                demo_bank = self.agent.make_demo_bank(self.replay_buffer, self.model)
+                state_dict = copy.deepcopy(self.model.state_dict())
+        if self.stream is not None:
+            self.stream.synchronize()
+        return state_dict, demo_bank, step
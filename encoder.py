@@ -1,9 +1,7 @@
 import torch
 import torch.nn as nn
 
-
-# Load the DINOv2 model only once
-DINO = None
+import dino
 
 
 def tie_weights(src, trg):
@@ -170,7 +168,7 @@ class DINOEncoder(nn.Module):
         self.obs_shape = obs_shape
         self.feature_dim = feature_dim
 
-        self.fc = nn.Linear(384 * (obs_shape[0] / 3), self.feature_dim)
+        self.fc = nn.Linear(dino.EMBED_DIM * (obs_shape[0] // 3), self.feature_dim)
         self.ln = nn.LayerNorm(self.feature_dim)
         self.dino = None
         self.outputs = dict()
@@ -179,20 +177,8 @@ class DINOEncoder(nn.Module):
 
     def dino_embed(self, obs):
         if self.dino is None:
-            global DINO
-            if DINO is not None:
-                self.dino = DINO
-            else:
-                self.dino = torch.hub.load(
-                    "facebookresearch/dinov2", "dinov2_vits14_reg"
-                ).to(obs.device)
-                DINO = self.dino
-
-        with torch.no_grad():
-            image1, image2 = torch.split(obs, [3, 3], dim=1)
-            dino_emb1 = self.dino(image1)
-            dino_emb2 = self.dino(image2)
-        return torch.cat([dino_emb1, dino_emb2], dim=1)
+            self.dino = dino.load_dino(obs.device)
+        return dino.dino_embed(self.dino, obs)
 
     def forward(self, obs, detach=False):
         h = self.dino_embed(obs)
@@ -0,0 +1,150 @@
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+class BatchPrefetcher(object):
+    """Samples RAD batches in a background thread into reusable buffers.
+
+    The worker keeps up to `num_batches` batches ready, plus the one the
+    learner is using. Each batch slot is a set of preallocated tensors,
+    refilled in place once the learner is done with it, so the update does
+    not wait on sampling, cropping or uploading.
+    """
+
+    def __init__(self, replay_buffer, aug_funcs, demo_density=None, num_batches=2):
+        assert num_batches > 0
+        assert (
+            replay_buffer.storage != "device"
+        ), "the device buffer already samples on the training device"
+        assert (
+            not replay_buffer.prioritized
+        ), "prioritized batches need their indexes for the priority update"
+        self.replay_buffer = replay_buffer
+        self.aug_funcs = aug_funcs
+        self.demo_density = demo_density
+        self.device = torch.device(replay_buffer.device)
+        self.num_batches = num_batches
+        self.use_cuda = self.device.type == "cuda"
+
+        self._slots = None
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        self._in_use = None
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._stall_time = 0.0
+        self._queue_depth = 0
+        self._num_gets = 0
+
+    def _allocate(self, arrays):
+        self._slots = []
+        for i in range(self.num_batches + 1):
+            host, dev = [], []
+            for array in arrays:
+                dtype = torch.from_numpy(np.empty(0, dtype=array.dtype)).dtype
+                # frames are uploaded as uint8 and normalized on the device
+                dev_dtype = torch.float32 if dtype == torch.uint8 else dtype
+                if self.use_cuda:
+                    host.append(torch.empty(array.shape, dtype=dtype).pin_memory())
+                else:
+                    host.append(None)
+                dev.append(
+                    torch.empty(array.shape, dtype=dev_dtype, device=self.device)
+                )
+            copy_done = torch.cuda.Event() if self.use_cuda else None
+            self._slots.append((host, dev, copy_done))
+            self._free.put((i, None))
+
+    def _fill(self, slot, arrays, stream):
+        host, dev, copy_done = self._slots[slot]
+        if not self.use_cuda:
+            for dst, src in zip(dev, arrays):
+                if src.dtype == np.uint8:
+                    torch.div(torch.from_numpy(src), 255.0, out=dst)
+                else:
+                    dst.copy_(torch.from_numpy(src))
+            return None
+
+        # the previous upload from these pinned buffers must be finished
+        copy_done.synchronize()
+        for dst, src in zip(host, arrays):
+            np.copyto(dst.numpy(), src)
+        with torch.cuda.stream(stream):
+            for dst, src in zip(dev, host):
+                dst.copy_(src, non_blocking=True)
+                if src.dtype == torch.uint8:
+                    dst.div_(255.0)
+            copy_done.record(stream)
+        return copy_done
+
+    def _run(self):
+        stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        try:
+            while not self._stop.is_set():
+                arrays = self.replay_buffer.sample_rad_arrays(
+                    self.aug_funcs, demo_density=self.demo_density
+                )
+                if self._slots is None:
+                    self._allocate(arrays)
+                while not self._stop.is_set():
+                    try:
+                        slot, released = self._free.get(timeout=0.1)
+                        break
+                    except queue.Empty:
+                        continue
+                else:
+                    return
+                if released is not None:
+                    # do not overwrite a batch the learner's kernels still read
+                    stream.wait_event(released)
+                self._ready.put((slot, self._fill(slot, arrays, stream)))
+        except Exception as e:
+            self._ready.put((None, e))
+
+    def get(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        if self._in_use is not None:
+            released = None
+            if self.use_cuda:
+                released = torch.cuda.Event()
+                released.record()
+            self._free.put((self._in_use, released))
+            self._in_use = None
+
+        self._queue_depth += self._ready.qsize()
+        self._num_gets += 1
+        time_start = time.time()
+        slot, ready = self._ready.get()
+        self._stall_time += time.time() - time_start
+        if slot is None:
+            raise ready
+        if ready is not None:
+            torch.cuda.current_stream().wait_event(ready)
+        self._in_use = slot
+
+        obses, actions, rewards, next_obses, not_dones = self._slots[slot][1]
+        obses, next_obses = self.replay_buffer.apply_tensor_augs(
+            self.aug_funcs, obses, next_obses
+        )
+        return obses, actions, rewards, next_obses, not_dones
+
+    def log(self, L, step):
+        if self._num_gets == 0:
+            return
+        L.log("train/prefetch_queue_depth", self._queue_depth / self._num_gets, step)
+        L.log("train/prefetch_stall_time", self._stall_time, step)
+        self._stall_time = 0.0
+        self._queue_depth = 0
+        self._num_gets = 0
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -3,7 +3,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import dino
 import utils
+from demo_bank import DemoLatentBank
+from e2c_schedule import E2CRefreshScheduler
+from e2c_trainer import AsyncE2CTrainer
 from encoder import make_encoder
 from data_augs import random_crop, center_crop, no_aug, batch_center_crop
 
@@ -232,6 +236,14 @@ class RadSacAgent(object):
         pretrain_mode=None,
         conv_layer_norm=False,
         p_reward=1,
+        demo_index="exact",
+        demo_index_probes=8,
+        bonus_cache=False,
+        bonus_refresh_batch=0,
+        async_e2c=False,
+        e2c_schedule="fixed",
+        e2c_check_interval=300,
+        e2c_max_interval=3000,
     ):
         self.device = device
         self.discount = discount
@@ -263,10 +275,36 @@ class RadSacAgent(object):
         self.num_filters = num_filters
 
         self.p_reward = p_reward
-        self.z_demo_cache = {}
+        self.demo_bank = None
+        self.demo_index = demo_index
+        self.demo_index_probes = demo_index_probes
         self.ref_one_step_dist = None
-
-        self.dino_embed_size = 384 * int(obs_shape[0] / 3)
+        # center-cropped demo frames on the device, see refresh_demo_bank
+        self.demo_next_obs = None
+        self.demo_encode_batch = 256
+        # with bonus_cache the bonus inputs of each transition are kept in the
+        # replay buffer, tagged with the demo bank (encoder) version
+        self.bonus_cache = bonus_cache
+        self.bonus_refresh_batch = bonus_refresh_batch
+        self.bonus_version = 0
+        self.bonus_refresh_cursor = 0
+        self.sampled_idxes = None
+        # background E2C refreshes, see e2c_trainer.py
+        self.async_e2c = async_e2c
+        self.e2c_trainer = None
+        # when and how long to retrain E2C, see e2c_schedule.py
+        self.e2c_schedule = e2c_schedule
+        self.e2c_check_interval = e2c_check_interval
+        self.e2c_max_interval = e2c_max_interval
+        self.e2c_scheduler = None
+        self.prefetcher = None
+        # set in train.py, receives the priority updates of update_sac
+        self.replay_buffer = None
+        # indexes and weights of the last prioritized batch of sample_batch
+        self.batch_idxes = None
+        self.batch_weights = None
+
+        self.dino_embed_size = dino.EMBED_DIM * (obs_shape[0] // 3)
 
         self.augs_funcs = {}
 
@@ -377,7 +415,9 @@ class RadSacAgent(object):
             mu, pi, _, _ = self.actor(obs, compute_log_pi=False)
             return pi.cpu().data.numpy().flatten()
 
-    def update_critic(self, obs, action, reward, next_obs, not_done, L, step):
+    def update_critic(
+        self, obs, action, reward, next_obs, not_done, L, step, weights=None
+    ):
         with torch.no_grad():
             _, policy_action, log_pi, _ = self.actor(next_obs)
 
@@ -399,9 +439,15 @@ class RadSacAgent(object):
         current_Q1, current_Q2 = self.critic(
             obs, action, detach_encoder=self.detach_encoder
         )
-        critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(
-            current_Q2, target_Q
-        )
+        if weights is None:
+            critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(
+                current_Q2, target_Q
+            )
+        else:
+            # importance sampling weights of a prioritized batch
+            critic_loss = (weights * (current_Q1 - target_Q) ** 2).mean() + (
+                weights * (current_Q2 - target_Q) ** 2
+            ).mean()
         if step % self.log_interval == 0:
             L.log("train_critic/loss", critic_loss, step)
 
@@ -412,6 +458,10 @@ class RadSacAgent(object):
 
         self.critic.log(L, step)
 
+        with torch.no_grad():
+            td_errors = target_Q - 0.5 * (current_Q1 + current_Q2)
+        return td_errors
+
     def update_actor_and_alpha(self, obs, L, step):
         # detach encoder, so we don't update it with the actor loss
         _, pi, log_pi, log_std = self.actor(obs, detach_encoder=True)
@@ -493,7 +543,13 @@ class RadSacAgent(object):
         if step % self.log_interval == 0:
             L.log("train/batch_reward", reward.mean(), step)
 
-        self.update_critic(obs, action, reward, next_obs, not_done, L, step)
+        td_errors = self.update_critic(
+            obs, action, reward, next_obs, not_done, L, step, self.batch_weights
+        )
+        if self.batch_idxes is not None:
+            self.replay_buffer.update_priorities(self.batch_idxes, td_errors)
+            self.batch_idxes = None
+            self.batch_weights = None
 
         if step % self.actor_update_freq == 0:
             self.update_actor_and_alpha(obs, L, step)
@@ -509,10 +565,256 @@ class RadSacAgent(object):
                 self.critic.encoder, self.critic_target.encoder, self.encoder_tau
             )
 
+        # DINO forwards saved by sharing the embeddings of this update's batches
+        hits, misses = dino.FEATURE_CACHE.pop_counts()
+        if step % self.log_interval == 0 and misses > 0:
+            L.log("train/dino_cache_hits", hits, step)
+            L.log("train/dino_cache_misses", misses, step)
+
+    def encode_bonus_obs(self, next_obs, e2c=None):
+        """Latents of normalized next_obs compared to the demo bank, with
+        self.e2c or the given E2C model."""
+        raise NotImplementedError
+
+    def encode_bonus_features(self, features, e2c=None):
+        """Latents of the stored frame features (see dino_features) compared
+        to the demo bank, with self.e2c or the given E2C model."""
+        raise NotImplementedError
+
+    def dino_features(self, replay_buffer, slots, next_obs=False):
+        """DINO features of the center crops of the obs (next_obs) of slots.
+
+        Read from the replay buffer's feature store, the frames without
+        features yet are embedded once, in batches, and stored.
+        """
+        self.fill_dino_features(replay_buffer, slots, next_obs)
+        return replay_buffer.get_features(slots, next_obs)
+
+    def fill_dino_features(self, replay_buffer, slots, next_obs=False):
+        """Embed and store the missing features of the obs (next_obs) of slots."""
+        missing, frames, writes = replay_buffer.missing_feature_frames(slots, next_obs)
+        if len(missing) == 0:
+            return
+        frames = self.crop_bonus_obs(replay_buffer, frames)
+        features = torch.cat(
+            [
+                self.dino_embed(batch.float() / 255)
+                for batch in frames.split(self.demo_encode_batch)
+            ]
+        )
+        replay_buffer.store_features(missing, features, writes, next_obs)
+
+    def bonus_latents(self, replay_buffer, slots, e2c=None):
+        """Bonus latents of the center crops of the next_obs of slots."""
+        with torch.no_grad():
+            if replay_buffer.feature_dim:
+                features = self.dino_features(replay_buffer, slots, next_obs=True)
+                return self.encode_bonus_features(features, e2c)
+            next_obs = self.crop_bonus_obs(
+                replay_buffer, replay_buffer.get_next_obses(slots)
+            )
+            return self.encode_bonus_obs(next_obs.float() / 255, e2c)
+
+    def crop_bonus_obs(self, replay_buffer, next_obses):
+        """The center crop of next_obses the bonus is computed on, uint8 on the
+        device."""
+        next_obses = next_obses[:, :, 8:120, 8:120]
+        return torch.as_tensor(next_obses, device=replay_buffer.device)
+
+    def make_demo_bank(self, replay_buffer, e2c=None):
+        """A DemoLatentBank of the demos encoded with self.e2c or e2c."""
+        bounds = list(zip(replay_buffer.demo_starts, replay_buffer.demo_ends))
+        slots = np.concatenate([np.arange(start, end) for start, end in bounds])
+        if replay_buffer.feature_dim:
+            # the demo features stay in the replay buffer's feature store
+            latents = self.bonus_latents(replay_buffer, slots, e2c)
+        else:
+            if self.demo_next_obs is None:
+                # the demos never change, crop and upload their frames once
+                self.demo_next_obs = self.crop_bonus_obs(
+                    replay_buffer, replay_buffer.get_next_obses(slots)
+                )
+            with torch.no_grad():
+                latents = torch.cat(
+                    [
+                        self.encode_bonus_obs(batch.float() / 255, e2c)
+                        for batch in self.demo_next_obs.split(self.demo_encode_batch)
+                    ]
+                )
+        # the previous bank warm starts the index after an encoder refresh
+        return DemoLatentBank(
+            latents.split([int(end - start) for start, end in bounds]),
+            self.demo_index,
+            self.demo_index_probes,
+            previous=self.demo_bank,
+        )
+
+    def set_demo_bank(self, demo_bank):
+        self.demo_bank = demo_bank
+        self.ref_one_step_dist = demo_bank.one_step_dist()
+        # the bonuses cached with the previous encoder are stale now
+        self.bonus_version += 1
+        self.bonus_refresh_cursor = 0
+
+    def refresh_demo_bank(self, replay_buffer):
+        """Encode the demos again, after the encoder changed."""
+        self.set_demo_bank(self.make_demo_bank(replay_buffer))
+
+    def refresh_e2c(self, replay_buffer, L, step, num_updates, mse_tol):
+        """Train the E2C model, then encode the demos with it.
+
+        With async_e2c, once there is a demo bank both run on a copy of the
+        model in the background and the SAC updates keep the current model
+        and bank until install_e2c swaps them in.
+        """
+        if self.async_e2c and self.demo_bank is not None:
+            if self.e2c_trainer is None:
+                self.e2c_trainer = AsyncE2CTrainer(self, replay_buffer)
+            # at most one refresh in flight bounds the staleness of the bonus
+            self.install_e2c(L, step, wait=True)
+            self.e2c_trainer.request(L, step, num_updates, mse_tol)
+            return
+
+        num_steps = self.update_e2c(
+            replay_buffer, L, step, num_updates, mse_tol=mse_tol
+        )
+        # an unchanged encoder leaves the demo latents and cached bonuses valid
+        if num_steps > 0 or self.demo_bank is None:
+            self.refresh_demo_bank(replay_buffer)
+            self.e2c_scheduler.refreshed(step)
+
+    def scheduled_e2c_refresh(self, replay_buffer, L, step):
+        """Start the E2C refresh the scheduler asks for at step, if any."""
+        num_updates, mse_tol = self.e2c_scheduler.decide(
+            step, lambda: self.e2c_recon_mse(replay_buffer), L
+        )
+        if num_updates > 0:
+            self.refresh_e2c(replay_buffer, L, step, num_updates, mse_tol)
+
+    def e2c_recon_mse(self, replay_buffer):
+        """Reconstruction MSE of the E2C model on recent transitions."""
+        raise NotImplementedError
+
+    def install_e2c(self, L, step, wait=False):
+        """Swap in the model and demo bank of a finished background refresh."""
+        if self.e2c_trainer is None:
+            return
+        result = self.e2c_trainer.result(wait)
+        if result is None:
+            return
+        state_dict, demo_bank, request_step = result
+        if demo_bank is not None:
+            self.e2c.load_state_dict(state_dict)
+            self.set_demo_bank(demo_bank)
+            self.e2c_scheduler.refreshed(step)
+        L.log("train/e2c_refresh_delay", step - request_step, step)
+
+    def refresh_bonuses(self, replay_buffer, slots):
+        if len(slots) == 0:
+            return
+        z_next = self.bonus_latents(replay_buffer, slots)
+        min_dist, discount_power = self.demo_bank.nearest(z_next)
+        replay_buffer.store_bonuses(slots, self.bonus_version, min_dist, discount_power)
+
+    def sweep_bonuses(self, replay_buffer):
+        """Refresh the stale bonuses of the next bonus_refresh_batch slots.
+
+        After a demo bank refresh this walks the buffer once in large batches,
+        so that sampled batches mostly find their bonus cached.
+        """
+        num_valid = replay_buffer.capacity if replay_buffer.full else replay_buffer.idx
+        start = self.bonus_refresh_cursor
+        if self.bonus_refresh_batch == 0 or start >= num_valid:
+            return
+        end = min(start + self.bonus_refresh_batch, num_valid)
+        self.bonus_refresh_cursor = end
+        self.refresh_bonuses(
+            replay_buffer,
+            replay_buffer.stale_bonus_slots(np.arange(start, end), self.bonus_version),
+        )
+
+    def compute_demo_bonus(self, replay_buffer, next_obs, not_done, L, step):
+        """LaNE bonus for next states close to a demonstration.
+
+        With bonus_cache, the bonus inputs of the sampled transitions are read
+        from the replay buffer and only recomputed for the stale ones, on the
+        center crop of their next_obs like the demos. So are the bonuses of
+        a replay buffer with a feature store, which only has center crops.
+
+        With n_step > 1 every state reached within the n steps gets its bonus,
+        discounted like the rewards, so the shaping matches 1-step LaNE. The
+        intermediate states are only in the replay buffer, so these bonuses
+        are computed per slot on center crops too.
+        """
+        if self.bonus_cache or replay_buffer.feature_dim or replay_buffer.n_step > 1:
+            slots, discounts = replay_buffer.bonus_slots(self.sampled_idxes)
+            slots = slots.reshape(-1)
+            if self.bonus_cache:
+                self.sweep_bonuses(replay_buffer)
+                self.refresh_bonuses(
+                    replay_buffer,
+                    replay_buffer.stale_bonus_slots(slots, self.bonus_version),
+                )
+                min_dist, discount_power = replay_buffer.get_bonuses(slots)
+            else:
+                min_dist, discount_power = self.demo_bank.nearest(
+                    self.bonus_latents(replay_buffer, slots)
+                )
+        else:
+            with torch.no_grad():
+                z_next = self.encode_bonus_obs(next_obs)
+            min_dist, discount_power = self.demo_bank.nearest(z_next)
+            discounts = np.ones((len(min_dist), 1), dtype=np.float32)
+
+        demo_reward_discount = 0.98
+        close = min_dist < self.ref_one_step_dist
+        if self.e2c_scheduler is not None:
+            self.e2c_scheduler.observe(min_dist, close, self.ref_one_step_dist)
+        discounts = torch.as_tensor(discounts, device=min_dist.device)
+        valid = discounts > 0
+        # only the last state of a transition can be terminal
+        last = valid.sum(dim=1, keepdim=True) - 1
+        steps = torch.arange(discounts.shape[1], device=min_dist.device)
+        nonterminal = (steps < last) | not_done.reshape(-1, 1).bool()
+        close = close.reshape(discounts.shape)
+        discount_power = discount_power.reshape(discounts.shape)
+        reward_mask = close & valid & nonterminal
+        additional_reward = (
+            demo_reward_discount**discount_power * reward_mask * discounts
+        ).sum(dim=1) * self.p_reward
+        if step % self.log_interval == 0:
+            L.log(
+                "train/avg_discount",
+                (discount_power * reward_mask).sum() / reward_mask.sum(),
+                step,
+            )
+            L.log("train/num_additional_reward", close.sum(), step)
+        return additional_reward.unsqueeze(1)
+
+    def sample_batch(self, replay_buffer, L, step, demo_density=None):
+        if self.prefetcher is not None and self.prefetcher.demo_density == demo_density:
+            if step % self.log_interval == 0:
+                self.prefetcher.log(L, step)
+            return self.prefetcher.get()
+        if (
+            replay_buffer.prioritized
+            or self.bonus_cache
+            or replay_buffer.feature_dim
+            or replay_buffer.n_step > 1
+        ):
+            batch = replay_buffer.sample_rad(
+                self.augs_funcs, demo_density=demo_density, return_idxes=True
+            )
+            self.sampled_idxes = batch[5]
+            if replay_buffer.prioritized:
+                self.batch_idxes, self.batch_weights = batch[5:]
+            return batch[:5]
+        return replay_buffer.sample_rad(self.augs_funcs, demo_density=demo_density)
+
     def update(self, replay_buffer, L, step, demo_density=None):
         if self.encoder_type == "pixel" or self.encoder_type == "dino":
-            obs, action, reward, next_obs, not_done = replay_buffer.sample_rad(
-                self.augs_funcs, demo_density=demo_density
+            obs, action, reward, next_obs, not_done = self.sample_batch(
+                replay_buffer, L, step, demo_density=demo_density
             )
         else:
             obs, action, reward, next_obs, not_done = replay_buffer.sample_proprio()
@@ -529,7 +831,22 @@ class RadSacAgent(object):
 
 
 class E2CSacAgent(RadSacAgent):
-    def update_e2c(self, replay_buffer, L, step, num_updates, init=False, mse_tol=None):
+    def update_e2c(
+        self,
+        replay_buffer,
+        L,
+        step,
+        num_updates,
+        init=False,
+        mse_tol=None,
+        e2c=None,
+        e2c_optimizer=None,
+    ):
+        """Returns the number of optimizer steps taken. Trains self.e2c unless
+        another model and its optimizer are given."""
+        if e2c is None:
+            e2c, e2c_optimizer = self.e2c, self.e2c_optimizer
+        num_steps = 0
         for i in range(num_updates):
             (
                 obs,
@@ -538,14 +855,18 @@ class E2CSacAgent(RadSacAgent):
                 obs_non_crop,
                 next_obs_non_crop,
             ) = replay_buffer.sample_e2c()
-            dkl, mse, ref_kl, predict = self.e2c(
+            dkl, mse, ref_kl, predict = e2c(
                 obs, action, next_obs, obs_non_crop, next_obs_non_crop
             )
             loss = dkl + mse * 128 * 128 * 6 + ref_kl
 
-            self.e2c_optimizer.zero_grad()
+            # within tolerance: stop before changing the weights
+            if mse_tol is not None and mse.detach().cpu().item() < mse_tol:
+                break
+            e2c_optimizer.zero_grad()
             loss.backward()
-            self.e2c_optimizer.step()
+            e2c_optimizer.step()
+            num_steps += 1
 
             if init:
                 folder = "train_e2c_init/"
@@ -580,13 +901,10 @@ class E2CSacAgent(RadSacAgent):
                 if i % 100 == 0:
                     print(f"E2C loss: {loss}")
 
-            if mse_tol is not None and mse.detach().cpu().item() < mse_tol:
-                break
-
         if not init:
             folder = "train_e2c_training/"
             if step % 10 == 0:
-                L._sw.add_scalar(folder + "updates", i + 1, step)
+                L._sw.add_scalar(folder + "updates", num_steps, step)
                 L._sw.add_scalar(folder + "dkl", dkl, step)
                 L._sw.add_scalar(folder + "mse", mse, step)
                 L._sw.add_scalar(folder + "ref_kl", ref_kl, step)
@@ -613,6 +931,17 @@ class E2CSacAgent(RadSacAgent):
                     predict[0][3:].detach().cpu().numpy().clip(0, 1),
                     global_step=step,
                 )
+        return num_steps
+
+    def encode_bonus_obs(self, next_obs, e2c=None):
+        return (self.e2c if e2c is None else e2c).enc(next_obs)[0]
+
+    def e2c_recon_mse(self, replay_buffer):
+        idxes = replay_buffer.recent_idxes(
+            replay_buffer.batch_size, self.e2c_scheduler.window
+        )
+        with torch.no_grad():
+            return self.e2c(*replay_buffer.sample_e2c(idxes))[1].item()
 
     def update(self, replay_buffer, L, step, demo_density=None):
         if self.e2c is None:
@@ -625,102 +954,60 @@ class E2CSacAgent(RadSacAgent):
                 crop_shape=self.obs_shape,
             ).to(self.device)
             self.e2c_optimizer = torch.optim.Adam(self.e2c.parameters(), lr=1e-4)
+            self.e2c_scheduler = E2CRefreshScheduler(
+                self.e2c_schedule,
+                max_updates=5000,
+                mse_tol=1e-2,
+                check_interval=self.e2c_check_interval,
+                max_interval=self.e2c_max_interval,
+            )
 
-        if step % 300 == 0 and self.p_reward != 0:
-            self.update_e2c(replay_buffer, L, step, 5000, mse_tol=1e-2)
-
-            one_step_dist_list = []
-
-            for i in range(len(replay_buffer.demo_starts)):
-                i_start = replay_buffer.demo_starts[i]
-                i_end = replay_buffer.demo_ends[i]
-                demo_next_obs = replay_buffer.next_obses[i_start:i_end, :, 8:120, 8:120]
-                demo_next_obs = (
-                    torch.as_tensor(demo_next_obs, device=replay_buffer.device).float()
-                    / 255
-                )
-                z_demo = (
-                    self.e2c.enc(demo_next_obs)[0].unsqueeze(0).detach().cpu().numpy()
-                )
-                self.z_demo_cache[i] = z_demo
-                one_step_dist_list.append(
-                    ((z_demo[0, 1:] - z_demo[0, :-1]) ** 2).sum(axis=1).mean()
-                )
-
-            self.ref_one_step_dist = np.mean(one_step_dist_list)
+        if self.p_reward != 0:
+            self.scheduled_e2c_refresh(replay_buffer, L, step)
+        self.install_e2c(L, step)
 
-        obs, action, reward, next_obs, not_done = replay_buffer.sample_rad(
-            self.augs_funcs, demo_density=demo_density
+        obs, action, reward, next_obs, not_done = self.sample_batch(
+            replay_buffer, L, step, demo_density=demo_density
         )
 
         if self.p_reward != 0:
-            z_pred = self.e2c.enc(next_obs)[0].unsqueeze(1).detach().cpu().numpy()
-
-            min_dist = np.ones(len(next_obs)) * 10000
-            discount_power = np.zeros(len(next_obs))
-            for i in range(len(replay_buffer.demo_starts)):
-                i_start = replay_buffer.demo_starts[i]
-                i_end = replay_buffer.demo_ends[i]
-                z_demo = self.z_demo_cache[i]
-                z_dist = ((z_demo - z_pred) ** 2).sum(axis=2)
-                z_dist_min = z_dist.min(axis=1)
-                update_min = z_dist_min < min_dist
-                min_dist[update_min] = z_dist_min[update_min]
-                discount_power[update_min] = (
-                    z_dist.shape[1] - z_dist.argmin(axis=1)[update_min]
-                )
-
-            demo_reward_discount = 0.98
-            reward_mask = np.logical_and(
-                min_dist < self.ref_one_step_dist,
-                not_done.detach().cpu().numpy().flatten(),
-            )
-            additional_reward = (
-                np.power(demo_reward_discount, discount_power)
-                * reward_mask
-                * self.p_reward
+            reward += self.compute_demo_bonus(
+                replay_buffer, next_obs, not_done, L, step
             )
-            if step % self.log_interval == 0:
-                L.log(
-                    "train/avg_discount",
-                    (discount_power * reward_mask).sum()
-                    / reward_mask.astype(int).sum(),
-                    step,
-                )
-                L.log(
-                    "train/num_additional_reward",
-                    (min_dist < self.ref_one_step_dist).sum(),
-                    step,
-                )
-
-            reward += torch.as_tensor(
-                additional_reward, device=reward.device
-            ).unsqueeze(1)
 
         self.update_sac(L, step, obs, action, reward, next_obs, not_done)
         # No contrastive updates
 
 
 class DINOE2CSacAgent(RadSacAgent):
-    def update_e2c(self, replay_buffer, L, step, num_updates, init=False, mse_tol=None):
+    def update_e2c(
+        self,
+        replay_buffer,
+        L,
+        step,
+        num_updates,
+        init=False,
+        mse_tol=None,
+        e2c=None,
+        e2c_optimizer=None,
+    ):
+        """Returns the number of optimizer steps taken. Trains self.e2c unless
+        another model and its optimizer are given."""
+        if e2c is None:
+            e2c, e2c_optimizer = self.e2c, self.e2c_optimizer
+        num_steps = 0
         for i in range(num_updates):
-            (
-                obs,
-                action,
-                next_obs,
-                obs_non_crop,
-                next_obs_non_crop,
-            ) = replay_buffer.sample_e2c()
-            dino_obs = self.dino_embed(obs)
-            dino_next_obs = self.dino_embed(next_obs)
-            dkl, mse, ref_kl, predict = self.e2c(
-                dino_obs, action, dino_next_obs, None, None
-            )
+            dino_obs, action, dino_next_obs = self.sample_dino_e2c(replay_buffer)
+            dkl, mse, ref_kl, predict = e2c(dino_obs, action, dino_next_obs, None, None)
             loss = dkl + mse * self.dino_embed_size + ref_kl
 
-            self.e2c_optimizer.zero_grad()
+            # within tolerance: stop before changing the weights
+            if mse_tol is not None and mse.detach().cpu().item() < mse_tol:
+                break
+            e2c_optimizer.zero_grad()
             loss.backward()
-            self.e2c_optimizer.step()
+            e2c_optimizer.step()
+            num_steps += 1
 
             if init:
                 folder = "train_e2c_init/"
@@ -733,26 +1020,46 @@ class DINOE2CSacAgent(RadSacAgent):
                 if i % 100 == 0:
                     print(f"E2C loss: {loss}")
 
-            if mse_tol is not None and mse.detach().cpu().item() < mse_tol:
-                break
-
         if not init:
             folder = "train_e2c_training/"
             if step % 10 == 0:
-                L._sw.add_scalar(folder + "updates", i + 1, step)
+                L._sw.add_scalar(folder + "updates", num_steps, step)
                 L._sw.add_scalar(folder + "dkl", dkl, step)
                 L._sw.add_scalar(folder + "mse", mse, step)
                 L._sw.add_scalar(folder + "ref_kl", ref_kl, step)
                 L._sw.add_scalar(folder + "loss", loss, step)
+        return num_steps
 
     def dino_embed(self, obs):
+        return dino.dino_embed(self.dino, obs)
+
+    def sample_dino_e2c(self, replay_buffer, idxes=None):
+        """(dino_obs, action, dino_next_obs) of an E2C batch. With a feature
+        store the features are those of the stored center crops instead of
+        random crops, and the transitions rewritten meanwhile are left out."""
+        if not replay_buffer.feature_dim:
+            obs, action, next_obs, _, _ = replay_buffer.sample_e2c(idxes)
+            return self.dino_embed(obs), action, self.dino_embed(next_obs)
+        if idxes is None:
+            idxes = replay_buffer.sample_e2c_idxes()
+        self.fill_dino_features(replay_buffer, idxes)
+        self.fill_dino_features(replay_buffer, idxes, next_obs=True)
+        return replay_buffer.get_e2c_features(idxes)
+
+    def encode_bonus_obs(self, next_obs, e2c=None):
+        return self.encode_bonus_features(self.dino_embed(next_obs), e2c)
+
+    def encode_bonus_features(self, features, e2c=None):
+        e2c = self.e2c if e2c is None else e2c
+        return e2c.enc(features)[0]
+
+    def e2c_recon_mse(self, replay_buffer):
+        idxes = replay_buffer.recent_idxes(
+            replay_buffer.batch_size, self.e2c_scheduler.window
+        )
         with torch.no_grad():
-            if obs.shape[1] == 3:
-                return self.dino(obs)
-            image1, image2 = torch.split(obs, [3, 3], dim=1)
-            dino_emb1 = self.dino(image1)
-            dino_emb2 = self.dino(image2)
-        return torch.cat([dino_emb1, dino_emb2], dim=1)
+            dino_obs, action, dino_next_obs = self.sample_dino_e2c(replay_buffer, idxes)
+            return self.e2c(dino_obs, action, dino_next_obs, None, None)[1].item()
 
     def update(self, replay_buffer, L, step, demo_density=None):
         if self.e2c is None:
@@ -764,178 +1071,62 @@ class DINOE2CSacAgent(RadSacAgent):
                 z_dimension=16,
                 crop_shape=None,
             ).to(self.device)
-            self.dino = torch.hub.load(
-                "facebookresearch/dinov2", "dinov2_vits14_reg"
-            ).to(self.device)
+            self.dino = dino.load_dino(self.device)
             self.e2c_optimizer = torch.optim.Adam(self.e2c.parameters(), lr=1e-4)
+            self.e2c_scheduler = E2CRefreshScheduler(
+                self.e2c_schedule,
+                max_updates=1000,
+                mse_tol=0.2,
+                check_interval=self.e2c_check_interval,
+                max_interval=self.e2c_max_interval,
+            )
 
-        if step % 300 == 0 and self.p_reward != 0:
-            self.update_e2c(replay_buffer, L, step, 1000, mse_tol=0.2)
-
-            one_step_dist_list = []
-
-            for i in range(len(replay_buffer.demo_starts)):
-                i_start = replay_buffer.demo_starts[i]
-                i_end = replay_buffer.demo_ends[i]
-                demo_next_obs = replay_buffer.next_obses[i_start:i_end, :, 8:120, 8:120]
-                demo_next_obs = (
-                    torch.as_tensor(demo_next_obs, device=replay_buffer.device).float()
-                    / 255
-                )
-                dino_demo_next_obs = self.dino_embed(demo_next_obs)
-                z_demo = (
-                    self.e2c.enc(dino_demo_next_obs)[0]
-                    .unsqueeze(0)
-                    .detach()
-                    .cpu()
-                    .numpy()
-                )
-                self.z_demo_cache[i] = z_demo
-                one_step_dist_list.append(
-                    ((z_demo[0, 1:] - z_demo[0, :-1]) ** 2).sum(axis=1).mean()
-                )
-
-            self.ref_one_step_dist = np.mean(one_step_dist_list)
+        if self.p_reward != 0:
+            self.scheduled_e2c_refresh(replay_buffer, L, step)
+        self.install_e2c(L, step)
 
         if self.encoder_type == "pixel":
-            obs, action, reward, next_obs, not_done = replay_buffer.sample_rad(
-                self.augs_funcs, demo_density=demo_density
+            obs, action, reward, next_obs, not_done = self.sample_batch(
+                replay_buffer, L, step, demo_density=demo_density
             )
         else:
-            obs, action, reward, next_obs, not_done = replay_buffer.sample_rad(
-                self.augs_funcs, demo_density=demo_density
+            obs, action, reward, next_obs, not_done = self.sample_batch(
+                replay_buffer, L, step, demo_density=demo_density
             )
 
         if self.p_reward != 0:
-            dino_next_obs = self.dino_embed(next_obs)
-            z_pred = self.e2c.enc(dino_next_obs)[0].unsqueeze(1).detach().cpu().numpy()
-
-            min_dist = np.ones(len(next_obs)) * 10000
-            discount_power = np.zeros(len(next_obs))
-            for i in range(len(replay_buffer.demo_starts)):
-                i_start = replay_buffer.demo_starts[i]
-                i_end = replay_buffer.demo_ends[i]
-                z_demo = self.z_demo_cache[i]
-                z_dist = ((z_demo - z_pred) ** 2).sum(axis=2)
-                z_dist_min = z_dist.min(axis=1)
-                update_min = z_dist_min < min_dist
-                min_dist[update_min] = z_dist_min[update_min]
-                discount_power[update_min] = (
-                    z_dist.shape[1] - z_dist.argmin(axis=1)[update_min]
-                )
-
-            demo_reward_discount = 0.98
-            reward_mask = np.logical_and(
-                min_dist < self.ref_one_step_dist,
-                not_done.detach().cpu().numpy().flatten(),
-            )
-            additional_reward = (
-                np.power(demo_reward_discount, discount_power)
-                * reward_mask
-                * self.p_reward
+            reward += self.compute_demo_bonus(
+                replay_buffer, next_obs, not_done, L, step
             )
-            if step % self.log_interval == 0:
-                L.log(
-                    "train/avg_discount",
-                    (discount_power * reward_mask).sum()
-                    / reward_mask.astype(int).sum(),
-                    step,
-                )
-                L.log(
-                    "train/num_additional_reward",
-                    (min_dist < self.ref_one_step_dist).sum(),
-                    step,
-                )
-
-            reward += torch.as_tensor(
-                additional_reward, device=reward.device
-            ).unsqueeze(1)
 
         self.update_sac(L, step, obs, action, reward, next_obs, not_done)
 
 
 class DINOOnlySacAgent(RadSacAgent):
     def dino_embed(self, obs):
-        with torch.no_grad():
-            image1, image2 = torch.split(obs, [3, 3], dim=1)
-            dino_emb1 = self.dino(image1)
-            dino_emb2 = self.dino(image2)
-        return torch.cat([dino_emb1, dino_emb2], dim=1)
+        return dino.dino_embed(self.dino, obs)
+
+    def encode_bonus_obs(self, next_obs, e2c=None):
+        return self.dino_embed(next_obs)
+
+    def encode_bonus_features(self, features, e2c=None):
+        return features
 
     def update(self, replay_buffer, L, step, demo_density=None):
         if self.dino is None:
-            self.dino = torch.hub.load(
-                "facebookresearch/dinov2", "dinov2_vits14_reg"
-            ).to(self.device)
+            self.dino = dino.load_dino(self.device)
 
         if step == 0 and self.p_reward != 0:
-            one_step_dist_list = []
-
-            for i in range(len(replay_buffer.demo_starts)):
-                i_start = replay_buffer.demo_starts[i]
-                i_end = replay_buffer.demo_ends[i]
-                demo_next_obs = replay_buffer.next_obses[i_start:i_end, :, 8:120, 8:120]
-                demo_next_obs = (
-                    torch.as_tensor(demo_next_obs, device=replay_buffer.device).float()
-                    / 255
-                )
-                dino_demo_next_obs = self.dino_embed(demo_next_obs)
-                z_demo = dino_demo_next_obs.unsqueeze(0).detach().cpu().numpy()
-                self.z_demo_cache[i] = z_demo
-                one_step_dist_list.append(
-                    ((z_demo[0, 1:] - z_demo[0, :-1]) ** 2).sum(axis=1).mean()
-                )
-
-            self.ref_one_step_dist = np.mean(one_step_dist_list)
+            self.refresh_demo_bank(replay_buffer)
 
-        obs, action, reward, next_obs, not_done = replay_buffer.sample_rad(
-            self.augs_funcs, demo_density=demo_density
+        obs, action, reward, next_obs, not_done = self.sample_batch(
+            replay_buffer, L, step, demo_density=demo_density
         )
 
         if self.p_reward != 0:
-            dino_next_obs = self.dino_embed(next_obs)
-            z_pred = dino_next_obs.unsqueeze(1).detach().cpu().numpy()
-
-            min_dist = np.ones(len(next_obs)) * 10000
-            discount_power = np.zeros(len(next_obs))
-            for i in range(len(replay_buffer.demo_starts)):
-                i_start = replay_buffer.demo_starts[i]
-                i_end = replay_buffer.demo_ends[i]
-                z_demo = self.z_demo_cache[i]
-                z_dist = ((z_demo - z_pred) ** 2).sum(axis=2)
-                z_dist_min = z_dist.min(axis=1)
-                update_min = z_dist_min < min_dist
-                min_dist[update_min] = z_dist_min[update_min]
-                discount_power[update_min] = (
-                    z_dist.shape[1] - z_dist.argmin(axis=1)[update_min]
-                )
-
-            demo_reward_discount = 0.98
-            reward_mask = np.logical_and(
-                min_dist < self.ref_one_step_dist,
-                not_done.detach().cpu().numpy().flatten(),
+            reward += self.compute_demo_bonus(
+                replay_buffer, next_obs, not_done, L, step
             )
-            additional_reward = (
-                np.power(demo_reward_discount, discount_power)
-                * reward_mask
-                * self.p_reward
-            )
-            if step % self.log_interval == 0:
-                L.log(
-                    "train/avg_discount",
-                    (discount_power * reward_mask).sum()
-                    / reward_mask.astype(int).sum(),
-                    step,
-                )
-                L.log(
-                    "train/num_additional_reward",
-                    (min_dist < self.ref_one_step_dist).sum(),
-                    step,
-                )
-
-            reward += torch.as_tensor(
-                additional_reward, device=reward.device
-            ).unsqueeze(1)
 
         self.update_sac(L, step, obs, action, reward, next_obs, not_done)
 
@@ -975,6 +1166,14 @@ class E2CILQRAgent(object):
         pretrain_mode=None,
         conv_layer_norm=False,
         p_reward=1,
+        demo_index="exact",
+        demo_index_probes=8,
+        bonus_cache=False,
+        bonus_refresh_batch=0,
+        async_e2c=False,
+        e2c_schedule="fixed",
+        e2c_check_interval=300,
+        e2c_max_interval=3000,
     ):
         self.device = device
         self.discount = discount
@@ -1005,8 +1204,16 @@ class E2CILQRAgent(object):
         self.num_filters = num_filters
 
         self.p_reward = p_reward
-        self.z_demo_cache = {}
+        self.demo_bank = None
+        self.demo_index = demo_index
+        self.demo_index_probes = demo_index_probes
         self.ref_one_step_dist = None
+        self.bonus_cache = bonus_cache
+        self.bonus_refresh_batch = bonus_refresh_batch
+        self.async_e2c = async_e2c
+        self.e2c_schedule = e2c_schedule
+        self.e2c_check_interval = e2c_check_interval
+        self.e2c_max_interval = e2c_max_interval
 
         self.augs_funcs = {}
 
@@ -1140,7 +1347,7 @@ class E2CILQRAgent(object):
 
     def compute_goal_embeddings(self):
         goal_indices = self.replay_buffer.demo_ends - 1
-        goal_obs = self.replay_buffer.next_obses[goal_indices, :, 8:120, 8:120]
+        goal_obs = self.replay_buffer.get_next_obses(goal_indices)[:, :, 8:120, 8:120]
         goal_obs = torch.as_tensor(goal_obs, device=self.device).float() / 255
         z_goal = self.e2c.enc(goal_obs)[0].unsqueeze(-1)
         return z_goal.mean(dim=0, keepdim=True)
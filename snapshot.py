@@ -0,0 +1,175 @@
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+
+FIELDS = ("obses", "next_obses", "actions", "rewards", "not_dones")
+# the episode links of the chunk slots, restored across chunks and runs
+LINK_FIELD = "prev_slots"
+
+
+class BufferSnapshotter(object):
+    """Streams new replay buffer transitions to raw .npz chunks in the background.
+
+    Each snapshot copies the slots written since the previous one (wrapping
+    around the ring if needed) and hands them to a writer thread. The
+    manifest lists the chunks in write order together with the buffer state,
+    and chunks whose slots have all been overwritten since are deleted.
+    """
+
+    def __init__(self, replay_buffer, save_dir):
+        self.replay_buffer = replay_buffer
+        self.save_dir = save_dir
+        self.manifest_path = os.path.join(save_dir, "manifest.json")
+        self.manifest = {"chunks": []}
+        self.next_chunk = 0
+        self.last_total = 0
+        self.saved_demos = False
+
+        # chunk id owning the latest copy of each slot, for pruning
+        self.slot_owner = np.full(replay_buffer.capacity, -1, dtype=np.int64)
+        self.live_slots = {}
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _new_ranges(self):
+        buf = self.replay_buffer
+        ranges = []
+        if not self.saved_demos and buf.keep_loaded_end > 0:
+            ranges.append((0, buf.keep_loaded_end))
+        self.saved_demos = True
+
+        wrap_start = buf.keep_loaded_end if buf.keep_loaded else 0
+        n = min(buf.total_added - self.last_total, buf.capacity - wrap_start)
+        self.last_total = buf.total_added
+        if n == 0:
+            return ranges
+        if buf.idx - n >= wrap_start:
+            ranges.append((buf.idx - n, buf.idx))
+        else:
+            ranges.append((buf.capacity - (n - (buf.idx - wrap_start)), buf.capacity))
+            if buf.idx > wrap_start:
+                ranges.append((wrap_start, buf.idx))
+        return ranges
+
+    def snapshot(self):
+        """Copy the transitions added since the last snapshot and queue them."""
+        buf = self.replay_buffer
+        with buf.lock:
+            ranges = self._new_ranges()
+            if not ranges:
+                return
+            slots = np.concatenate([np.arange(start, end) for start, end in ranges])
+            chunk = {
+                "slots": slots,
+                "obses": buf.get_obses(slots),
+                "next_obses": buf.get_next_obses(slots),
+                "actions": buf.actions[slots],
+                "rewards": buf.rewards[slots],
+                "not_dones": buf.not_dones[slots],
+                LINK_FIELD: buf.prev_slots[slots],
+            }
+            state = {
+                "idx": int(buf.idx),
+                "full": bool(buf.full),
+                "keep_loaded_end": int(buf.keep_loaded_end),
+                "total_added": int(buf.total_added),
+                "demo_starts": (
+                    None if buf.demo_starts is None else list(map(int, buf.demo_starts))
+                ),
+                "demo_ends": (
+                    None if buf.demo_ends is None else list(map(int, buf.demo_ends))
+                ),
+            }
+            buf.last_save = buf.idx
+        if buf.storage == "device":
+            chunk = {k: torch.as_tensor(v).cpu().numpy() for k, v in chunk.items()}
+        self._queue.put((chunk, state))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._write(*item)
+
+    def _write(self, chunk, state):
+        chunk_id = self.next_chunk
+        self.next_chunk += 1
+        file_name = "chunk_%06d.npz" % chunk_id
+        path = os.path.join(self.save_dir, file_name)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, **chunk)
+        os.replace(path + ".tmp", path)
+
+        slots = chunk["slots"]
+        old_owners, counts = np.unique(self.slot_owner[slots], return_counts=True)
+        self.slot_owner[slots] = chunk_id
+        self.live_slots[chunk_id] = len(slots)
+        stale = []
+        for owner, count in zip(old_owners, counts):
+            if owner < 0:
+                continue
+            self.live_slots[owner] -= count
+            if self.live_slots[owner] == 0:
+                stale.append("chunk_%06d.npz" % owner)
+
+        self.manifest["chunks"] = [
+            c for c in self.manifest["chunks"] if c["file"] not in stale
+        ] + [{"file": file_name, "num": len(slots)}]
+        self.manifest.update(state)
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+        for stale_file in stale:
+            os.remove(os.path.join(self.save_dir, stale_file))
+
+    def close(self):
+        """Wait until every queued snapshot is on disk."""
+        self._queue.put(None)
+        self._thread.join()
+
+
+def restore_snapshots(replay_buffer, save_dir):
+    """Replay the snapshot chunks of save_dir into an empty replay buffer."""
+    with open(os.path.join(save_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    # the chunk holding the latest copy of each slot, and the links recorded
+    owner = np.full(replay_buffer.capacity, -1, dtype=np.int64)
+    links = []
+    for i, chunk in enumerate(manifest["chunks"]):
+        with np.load(os.path.join(save_dir, chunk["file"])) as data:
+            slots = data["slots"]
+            fields = [data[k] for k in FIELDS]
+            if LINK_FIELD in data:
+                links.append((i, slots, data[LINK_FIELD]))
+        # write each run of consecutive slots in one go
+        breaks = np.flatnonzero(np.diff(slots) != 1) + 1
+        for run in np.split(np.arange(len(slots)), breaks):
+            replay_buffer._write_range(slots[run[0]], *[f[run] for f in fields])
+        owner[slots] = i
+
+    # _write_range only links within a run. A recorded link still holds if
+    # neither slot was rewritten by a later chunk: the predecessor was
+    # snapshotted with or before its successor, which was not rewritten since
+    for i, slots, prevs in links:
+        current = (owner[slots] == i) & (prevs >= 0)
+        slots, prevs = slots[current], prevs[current]
+        current = (owner[prevs] >= 0) & (owner[prevs] <= i)
+        for prev, slot in zip(prevs[current], slots[current]):
+            if replay_buffer.next_slots[prev] != slot:
+                replay_buffer._link(prev, slot)
+
+    replay_buffer.idx = manifest["idx"]
+    replay_buffer.last_save = manifest["idx"]
+    replay_buffer.full = manifest["full"]
+    replay_buffer.keep_loaded_end = manifest["keep_loaded_end"]
+    replay_buffer.total_added = manifest["total_added"]
+    replay_buffer.demo_starts = manifest["demo_starts"]
+    replay_buffer.demo_ends = manifest["demo_ends"]
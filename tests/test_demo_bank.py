@@ -0,0 +1,21 @@
+import torch
+
+from demo_bank import DemoLatentBank
+
+
+def test_ivf_search_falls_back_to_exact_on_a_miss():
+    torch.manual_seed(0)
+    bank = DemoLatentBank(
+        [torch.randn(50, 8) for _ in range(4)], index="ivf", n_probe=2
+    )
+    z = torch.randn(16, 8)
+    # no finite distance to any latent
+    z[3] = float("inf")
+
+    rows = bank.index.search(z, (z**2).sum(dim=1))[1]
+    min_dist, discount_power = bank.nearest(z)
+    exact_dist, exact_power = bank.nearest(z, exact=True)
+
+    assert rows[3] == -1 and (rows[torch.arange(16) != 3] >= 0).all()
+    assert torch.isinf(min_dist[3])
+    assert discount_power[3] == exact_power[3]
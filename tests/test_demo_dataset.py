@@ -0,0 +1,47 @@
+import numpy as np
+
+import utils
+from demo_dataset import _Writer
+
+
+def write_dataset(path, lengths, shape=(6, 16, 16)):
+    writer = _Writer(
+        str(path),
+        len(lengths),
+        sum(lengths) + len(lengths),
+        np.zeros(shape, np.uint8),
+        np.zeros(2, np.float32),
+    )
+    for i, n in enumerate(lengths):
+        frames = np.full((n + 1, *shape), i, np.uint8)
+        frames[:, 0, 0, 0] = np.arange(n + 1)
+        writer.write(
+            frames,
+            np.zeros((n, 2), np.float32),
+            np.zeros((n, 1), np.float32),
+            [[True]] * (n - 1) + [[False]],
+        )
+    writer.close()
+
+
+def test_load_all_demos_without_num_traj(tmp_path):
+    lengths = [5, 7, 3]
+    write_dataset(tmp_path, lengths)
+    buffer = utils.ReplayBuffer((6, 16, 16), (2,), 100, 4, "cpu", None)
+
+    buffer.load_demo_dataset(str(tmp_path), num_traj=None)
+
+    assert len(buffer.demo_starts) == len(lengths)
+    assert buffer.keep_loaded_end == buffer.idx == sum(lengths)
+    assert sorted(
+        int(end - start) for start, end in zip(buffer.demo_starts, buffer.demo_ends)
+    ) == sorted(lengths)
+
+
+def test_load_some_demos(tmp_path):
+    write_dataset(tmp_path, [5, 7, 3])
+    buffer = utils.ReplayBuffer((6, 16, 16), (2,), 100, 4, "cpu", None)
+
+    buffer.load_demo_dataset(str(tmp_path), num_traj=2)
+
+    assert len(buffer.demo_starts) == 2
@@ -0,0 +1,39 @@
+import threading
+
+import torch
+
+import dino
+
+
+def embed(model, obs):
+    with torch.no_grad():
+        return model(obs.flatten(1))
+
+
+def test_feature_cache_is_per_thread():
+    cache = dino.DINOFeatureCache()
+    model = torch.nn.Linear(12, 4)
+    obs = torch.rand(2, 3, 2, 2)
+    cache.get(model, obs, embed)
+    cache.get(model, obs, embed)
+
+    def background():
+        # a batch of another thread neither hits the entries of this one nor
+        # counts towards it
+        cache.get(model, obs, embed)
+        other = torch.rand(2, 3, 2, 2)
+        cache.get(model, other, embed)
+        background.counts = cache.pop_counts()
+
+    thread = threading.Thread(target=background)
+    thread.start()
+    thread.join()
+
+    assert background.counts == (0, 2)
+    assert cache.pop_counts() == (1, 1)
+    assert len(cache.local.entries) == 1
+    obs.mul_(2)
+    cache.get(model, obs, embed)
+    assert cache.pop_counts() == (0, 1)
+    del obs
+    assert len(cache.local.entries) == 0
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import utils
+
+
+def make_buffer(storage_dir, obs_shape=(3, 8, 8), action_shape=(2,)):
+    return utils.ReplayBuffer(
+        obs_shape,
+        action_shape,
+        20,
+        4,
+        "cpu",
+        None,
+        storage="memmap",
+        storage_dir=str(storage_dir),
+    )
+
+
+def test_reopen_keeps_transitions(tmp_path):
+    buffer = make_buffer(tmp_path)
+    obs = np.full((3, 8, 8), 7, np.uint8)
+    buffer.add(obs, np.ones(2), 1.0, obs, False)
+    buffer.checkpoint()
+
+    reopened = make_buffer(tmp_path)
+
+    assert reopened.idx == 1
+    np.testing.assert_array_equal(reopened.obses[0], obs)
+
+
+@pytest.mark.parametrize("shapes", [{"obs_shape": (3, 16, 16)}, {"action_shape": (4,)}])
+def test_reopen_rejects_other_shapes(tmp_path, shapes):
+    make_buffer(tmp_path).checkpoint()
+
+    with pytest.raises(ValueError, match="reopened with different"):
+        make_buffer(tmp_path, **shapes)
+
+
+def test_reopen_rejects_other_dtype(tmp_path):
+    make_buffer(tmp_path).checkpoint()
+    np.save(tmp_path / "rewards.npy", np.zeros((20, 1), np.float64))
+
+    with pytest.raises(ValueError, match="rewards.npy"):
+        make_buffer(tmp_path)
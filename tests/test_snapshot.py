@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import utils
+from snapshot import BufferSnapshotter, restore_snapshots
+
+FRAME_SHAPE = (3, 8, 8)
+
+
+def make_buffer(frame_stack):
+    obs_shape = (3 * frame_stack, *FRAME_SHAPE[1:])
+    return utils.ReplayBuffer(
+        obs_shape,
+        (2,),
+        50,
+        4,
+        "cpu",
+        None,
+        frame_stack=frame_stack,
+        dedup_frames=frame_stack > 1,
+    )
+
+
+def fill(buffer, snapshotter, frame_stack, lengths, snapshot_every):
+    step = 0
+    for episode, length in enumerate(lengths):
+        frames = np.zeros((length + 1, *FRAME_SHAPE), np.uint8)
+        frames[:, 0, 0, 0] = episode
+        frames[:, 1, 0, 0] = np.arange(length + 1)
+        # stacked obs repeat the first frame at the episode start
+        stacks = [
+            np.concatenate(
+                [frames[max(t - k, 0)] for k in reversed(range(frame_stack))]
+            )
+            for t in range(length + 1)
+        ]
+        for t in range(length):
+            buffer.add(stacks[t], np.zeros(2), 0.0, stacks[t + 1], t == length - 1)
+            step += 1
+            if step % snapshot_every == 0:
+                snapshotter.snapshot()
+    snapshotter.snapshot()
+    snapshotter.close()
+
+
+@pytest.mark.parametrize("frame_stack", [1, 2])
+def test_restore_keeps_episodes_across_chunks(tmp_path, frame_stack):
+    # snapshots every 7 steps split the episodes across chunks, and the ring
+    # wraps around so that the oldest chunks are pruned
+    buffer = make_buffer(frame_stack)
+    fill(
+        buffer,
+        BufferSnapshotter(buffer, str(tmp_path)),
+        frame_stack,
+        [9, 23, 4, 31, 17, 12],
+        7,
+    )
+    restored = make_buffer(frame_stack)
+
+    restore_snapshots(restored, str(tmp_path))
+
+    assert restored.idx == buffer.idx and restored.full == buffer.full
+    np.testing.assert_array_equal(restored.next_slots, buffer.next_slots)
+    np.testing.assert_array_equal(restored.prev_slots, buffer.prev_slots)
+    slots = np.arange(buffer.capacity)
+    np.testing.assert_array_equal(restored.get_obses(slots), buffer.get_obses(slots))
+    np.testing.assert_array_equal(
+        restored.get_next_obses(slots), buffer.get_next_obses(slots)
+    )
@@ -4,10 +4,13 @@ import argparse
 import os
 import time
 import json
+import dino
 import utils
 
-from data_augs import center_crop
+from data_augs import center_crop, set_num_threads
 from logger import Logger
+from prefetch import BatchPrefetcher
+from snapshot import BufferSnapshotter, restore_snapshots
 from video import VideoRecorder
 
 from sac import (
@@ -43,6 +46,19 @@ def parse_args():
     parser.add_argument(
         "--replay_buffer_keep_loaded", default=False
     )
+    parser.add_argument("--replay_buffer_dedup", default=False)
+    parser.add_argument("--replay_buffer_storage", default="memory", type=str)
+    parser.add_argument("--replay_buffer_dir", default=None, type=str)
+    parser.add_argument("--replay_buffer_codec", default="zlib", type=str)
+    parser.add_argument("--replay_buffer_decode_threads", default=0, type=int)
+    parser.add_argument("--replay_buffer_restore_dir", default=None, type=str)
+    parser.add_argument("--n_step", default=1, type=int)
+    parser.add_argument("--sample_blocks", default=0, type=int)
+    parser.add_argument("--sample_block_size", default=64, type=int)
+    parser.add_argument("--prioritized_replay", default=False)
+    parser.add_argument("--priority_alpha", default=0.6, type=float)
+    parser.add_argument("--priority_beta", default=0.4, type=float)
+    parser.add_argument("--prefetch_batches", default=0, type=int)
     parser.add_argument("--model_dir", default=None, type=str)
     parser.add_argument("--model_step", default=None, type=str)
     parser.add_argument("--n_demos", default=None, type=int)
@@ -100,10 +116,38 @@ def parse_args():
     parser.add_argument("--final_demo_density", default=None, type=float)
 
     parser.add_argument("--data_augs", default="crop", type=str)
+    parser.add_argument("--crop_threads", default=0, type=int)
     parser.add_argument("--log_interval", default=200, type=int)
     parser.add_argument("--pretrain_mode", default=None, type=str)
     parser.add_argument("--conv_layer_norm", default=False)
     parser.add_argument("--p_reward", default=1, type=float)
+    # nearest-demo search of the bonus: exact or an approximate k-means index
+    parser.add_argument("--demo_index", default="exact", choices=["exact", "ivf"])
+    parser.add_argument("--demo_index_probes", default=8, type=int)
+    # cache the bonus inputs per transition in the replay buffer, refreshing
+    # this many of them per step after each encoder refresh (0: on sample only)
+    parser.add_argument("--bonus_cache", default=False)
+    parser.add_argument("--bonus_refresh_batch", default=0, type=int)
+    # train the E2C model and rebuild the demo bank in a background thread
+    parser.add_argument("--async_e2c", default=False)
+    # retrain E2C every check interval, or only when drift signals say so
+    parser.add_argument(
+        "--e2c_schedule", default="fixed", choices=["fixed", "adaptive"]
+    )
+    parser.add_argument("--e2c_check_interval", default=300, type=int)
+    parser.add_argument("--e2c_max_interval", default=3000, type=int)
+    # keep the DINOv2 features of each stored frame (center crop, float16 per
+    # camera) in the replay buffer, for the dino agents
+    parser.add_argument("--dino_feature_store", default=False)
+    # inference precision of the frozen DINO backbone, check it first with
+    # python dino.py --demos <demo dataset>; int8 is CPU only
+    parser.add_argument("--dino_precision", default="fp32", choices=dino.PRECISIONS)
+    # load DINO offline: a local clone of facebookresearch/dinov2, and/or a
+    # state dict or a backbone exported by python dino.py --export
+    parser.add_argument("--dino_repo", default=None, type=str)
+    parser.add_argument("--dino_model", default=None, type=str)
+    # load and run DINO once before training instead of in the first update
+    parser.add_argument("--dino_warm_up", default=False)
 
     args = parser.parse_args()
     return args
@@ -239,6 +283,14 @@ def make_agent(obs_shape, action_shape, args, device):
         conv_layer_norm=args.conv_layer_norm,
         data_augs=args.data_augs,
         p_reward=args.p_reward,
+        demo_index=args.demo_index,
+        demo_index_probes=args.demo_index_probes,
+        bonus_cache=args.bonus_cache,
+        bonus_refresh_batch=args.bonus_refresh_batch,
+        async_e2c=args.async_e2c,
+        e2c_schedule=args.e2c_schedule,
+        e2c_check_interval=args.e2c_check_interval,
+        e2c_max_interval=args.e2c_max_interval,
     )
 
 
@@ -248,6 +300,8 @@ def main():
         args.__dict__["seed"] = np.random.randint(1, 1000000)
     exp_id = str(int(np.random.random() * 100000))
     utils.set_seed_everywhere(args.seed)
+    set_num_threads(args.crop_threads)
+    dino.configure(args.dino_precision, args.dino_repo, args.dino_model)
 
     env = make_env(args)
 
@@ -320,6 +374,10 @@ def main():
         obs_shape = env.observation_space.shape
         pre_aug_obs_shape = obs_shape
 
+    assert not args.dino_feature_store or args.agent in (
+        "dino_e2c_sac",
+        "dino_only_sac",
+    ), "only the dino agents use the feature store"
     replay_buffer = utils.ReplayBuffer(
         obs_shape=pre_aug_obs_shape,
         action_shape=action_shape,
@@ -330,23 +388,70 @@ def main():
         image_size=args.image_size,
         load_dir=args.replay_buffer_load_dir,
         keep_loaded=args.replay_buffer_keep_loaded,
+        frame_stack=args.frame_stack if args.replay_buffer_dedup else 1,
+        n_step=args.n_step,
+        discount=args.discount,
+        sample_blocks=args.sample_blocks,
+        sample_block_size=args.sample_block_size,
+        dedup_frames=args.replay_buffer_dedup,
+        storage=args.replay_buffer_storage,
+        storage_dir=args.replay_buffer_dir or buffer_dir,
+        frame_codec=args.replay_buffer_codec,
+        decode_threads=args.replay_buffer_decode_threads,
+        prioritized=args.prioritized_replay,
+        priority_alpha=args.priority_alpha,
+        priority_beta=args.priority_beta,
+        feature_dim=dino.EMBED_DIM if args.dino_feature_store else 0,
     )
 
+    if args.replay_buffer_restore_dir is not None:
+        restore_snapshots(replay_buffer, args.replay_buffer_restore_dir)
+    snapshotter = None
+    if args.save_buffer and args.replay_buffer_storage != "memmap":
+        snapshotter = BufferSnapshotter(replay_buffer, buffer_dir)
+
     print("Starting with replay buffer filled to {}.".format(replay_buffer.idx))
 
     agent = make_agent(
         obs_shape=obs_shape, action_shape=action_shape, args=args, device=device
     )
     agent.replay_buffer = replay_buffer
+    if args.prefetch_batches > 0 and (
+        args.encoder_type == "pixel" or args.encoder_type == "dino"
+    ):
+        assert not args.bonus_cache, "cached bonuses need the sampled indexes"
+        assert not args.dino_feature_store, "stored features need the sampled indexes"
+        assert args.n_step == 1 or args.p_reward == 0 or args.agent not in (
+            "e2c_sac",
+            "dino_e2c_sac",
+            "dino_only_sac",
+        ), "n-step bonuses need the sampled indexes"
+        agent.prefetcher = BatchPrefetcher(
+            replay_buffer,
+            agent.augs_funcs,
+            demo_density=args.final_demo_density,
+            num_batches=args.prefetch_batches,
+        )
     if args.model_dir is not None:
         agent.load(args.model_dir, args.model_step)
     L = Logger(args)
+    uses_dino = args.encoder_type == "dino" or args.agent in (
+        "dino_e2c_sac",
+        "dino_only_sac",
+    )
+    if uses_dino and args.dino_warm_up:
+        warm_up_time = dino.warm_up(
+            device, len(args.cameras), args.image_size, args.batch_size
+        )
+        L.log("train/dino_warm_up_time", warm_up_time, 0)
 
     episode, episode_reward, done = 0, 0, True
     start_time = time.time()
 
     def eval_and_save():
-        if args.save_buffer:
+        if snapshotter is not None:
+            snapshotter.snapshot()
+        elif args.replay_buffer_storage == "memmap":
             replay_buffer.save(buffer_dir)
         if args.save_sac:
             agent.save(model_dir, step)
@@ -397,6 +502,11 @@ def main():
                 else:
                     demo_density = None
                 agent.update(replay_buffer, L, step, demo_density=demo_density)
+            if step == args.init_steps:
+                # includes loading DINO unless it was warmed up
+                L.log("train/first_update_time", time.time() - time_start, step)
+                if dino.LOAD_TIME is not None:
+                    L.log("train/dino_load_time", dino.LOAD_TIME, step)
 
         time_computing += time.time() - time_start
 
@@ -419,6 +529,10 @@ def main():
     print("time spent computing:", time_computing)
     print("time spent acting:", time_acting)
     eval_and_save()
+    if agent.prefetcher is not None:
+        agent.prefetcher.close()
+    if snapshotter is not None:
+        snapshotter.close()
     env.close()
 
 
@@ -2,11 +2,16 @@ import torch
 import numpy as np
 import gymnasium as gym
 import os
+import json
+import threading
 from collections import deque
 import random
 from torch.utils.data import Dataset
 from torch import nn
+from chunked_array import ChunkedArray
+from compressed_frames import CompressedFrames
 from data_augs import random_crop
+from demo_dataset import DemoDataset, is_demo_dataset
 
 
 class eval_mode(object):
@@ -46,6 +51,65 @@ def make_dir(dir_path):
     return dir_path
 
 
+class SumTree(object):
+    """Binary sum tree over `capacity` leaves, updated and searched in batches.
+
+    Each level of the tree is processed with one vectorized numpy operation,
+    so a batch update or sample costs O(log N) array ops.
+    """
+
+    def __init__(self, capacity):
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+        self.tree = np.zeros(2 * self.size, dtype=np.float64)
+        self.max_priority = 1.0
+
+    def update(self, idxes, priorities):
+        nodes = np.asarray(idxes, dtype=np.int64).reshape(-1) + self.size
+        if len(nodes) == 0:
+            return
+        self.tree[nodes] = priorities
+        while True:
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            if nodes[0] == 1:
+                return
+
+    def prefix_sum(self, end):
+        """Sum of the leaves before `end`."""
+        if end >= self.size:
+            return self.tree[1]
+        total = 0.0
+        node = end + self.size
+        while node > 1:
+            if node % 2 == 1:
+                total += self.tree[node - 1]
+            node //= 2
+        return total
+
+    def find(self, values):
+        """Leaf whose prefix sum interval contains each value."""
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        while nodes[0] < self.size:
+            left = self.tree[2 * nodes]
+            go_right = values >= left
+            values -= left * go_right
+            nodes = 2 * nodes + go_right
+        return nodes - self.size
+
+    def sample(self, start, end, n):
+        """Stratified sample of n leaves of [start, end), proportional to priority.
+
+        Returns the leaves and their probability within the range.
+        """
+        low, high = self.prefix_sum(start), self.prefix_sum(end)
+        values = low + (high - low) * (np.arange(n) + np.random.rand(n)) / n
+        idxes = np.clip(self.find(values), start, end - 1)
+        return idxes, self.tree[idxes + self.size] / (high - low)
+
+
 class ReplayBuffer(Dataset):
     """Buffer to store environment transitions."""
 
@@ -61,44 +125,407 @@ class ReplayBuffer(Dataset):
         image_size=84,
         transform=None,
         keep_loaded=False,
+        frame_stack=1,
+        n_step=1,
+        discount=0.99,
+        dedup_frames=False,
+        storage="memory",
+        storage_dir=None,
+        frame_codec="zlib",
+        decode_threads=0,
+        sample_blocks=0,
+        sample_block_size=64,
+        prioritized=False,
+        priority_alpha=0.6,
+        priority_beta=0.4,
+        priority_eps=1e-6,
+        feature_dim=0,
     ):
+        assert storage in (
+            "memory",
+            "memmap",
+            "device",
+            "compressed",
+            "chunked",
+        ), "invalid buffer storage"
+        assert storage != "memmap" or storage_dir is not None
+        assert not (
+            storage == "device" and dedup_frames
+        ), "the device storage does not support dedup_frames"
+        assert frame_stack == 1 or dedup_frames, "frame stacks need dedup_frames"
         self.capacity = capacity
         self.batch_size = batch_size
         self.device = device
         self.image_size = image_size
         self.transform = transform
+        self.dedup_frames = dedup_frames
+        self.storage = storage
+        self.storage_dir = storage_dir
+        self.frame_codec = frame_codec
+        self.decode_threads = decode_threads
+        # an existing memmap directory is reopened instead of being overwritten
+        self.reopened = storage == "memmap" and os.path.exists(
+            os.path.join(storage_dir, "meta.json")
+        )
+        if storage == "memmap":
+            make_dir(storage_dir)
         # the proprioceptive obs is stored as float32, pixels obs as uint8
         obs_dtype = np.float32 if len(obs_shape) == 1 else np.uint8
+        # with frame stacking only the newest frame of each obs is stored
+        self.frame_stack = frame_stack
+        self.frame_channels = obs_shape[0] // frame_stack
+        frame_shape = (self.frame_channels, *obs_shape[1:])
 
-        self.obses = np.empty((capacity, *obs_shape), dtype=obs_dtype)
-        self.next_obses = np.empty((capacity, *obs_shape), dtype=obs_dtype)
-        self.actions = np.empty((capacity, *action_shape), dtype=np.float32)
-        self.rewards = np.empty((capacity, 1), dtype=np.float32)
-        self.not_dones = np.empty((capacity, 1), dtype=bool)
+        self.obses = self._alloc("obses", (capacity, *frame_shape), obs_dtype)
+        # episode index: the slot of the following / preceding transition of
+        # the same episode, or -1. Kept on the host for the device storage
+        if storage == "device":
+            self.next_slots = np.full(capacity, -1, dtype=np.int64)
+            self.prev_slots = np.full(capacity, -1, dtype=np.int64)
+        else:
+            self.next_slots = self._alloc("next_slots", (capacity,), np.int64, -1)
+            self.prev_slots = self._alloc("prev_slots", (capacity,), np.int64, -1)
+        self.last_slot = -1
+        # last slot of each env for add_batch
+        self.batch_last_slots = None
+        if dedup_frames:
+            # next_obs is read from the slot of the following transition of the
+            # same episode, or from the terminal frame store at episode ends
+            self.next_obses = None
+            self.terminal_obses = self._alloc(
+                "terminal_obses", (64, *frame_shape), obs_dtype
+            )
+            self.terminal_slots = self._alloc(
+                "terminal_slots", (capacity,), np.int64, -1
+            )
+            in_use = set(self.terminal_slots[self.terminal_slots >= 0].tolist())
+            self.free_terminals = [
+                t
+                for t in range(len(self.terminal_obses) - 1, -1, -1)
+                if t not in in_use
+            ]
+        if frame_stack > 1:
+            # the k - 1 frames before a slot without predecessor, -2 if they
+            # repeat the slot's frame like after FrameStack.reset
+            self.head_obses = self._alloc(
+                "head_obses", (16, frame_stack - 1, *frame_shape), obs_dtype
+            )
+            self.head_slots = self._alloc("head_slots", (capacity,), np.int64, -1)
+            in_use = set(self.head_slots[self.head_slots >= 0].tolist())
+            self.free_heads = [
+                h for h in range(len(self.head_obses) - 1, -1, -1) if h not in in_use
+            ]
+        if not dedup_frames:
+            self.next_obses = self._alloc(
+                "next_obses", (capacity, *obs_shape), obs_dtype
+            )
+            # host copy of the last next_obs, to find continuing episodes
+            self.last_next_obs = None
+        self.actions = self._alloc("actions", (capacity, *action_shape), np.float32)
+        self.rewards = self._alloc("rewards", (capacity, 1), np.float32)
+        self.not_dones = self._alloc("not_dones", (capacity, 1), bool)
 
         self.idx = 0
         self.last_save = 0
+        # number of add() calls, used to find the slots written since a save
+        self.total_added = 0
         self.full = False
         self.keep_loaded = keep_loaded
         self.keep_loaded_end = 0
+        # sampled transitions span up to n_step steps of their episode
+        self.n_step = n_step
+        self.discount = discount
+        # with sample_blocks > 0, batches are drawn from that many random
+        # runs of sample_block_size contiguous slots, see _sample_range
+        self.sample_blocks = sample_blocks
+        self.sample_block_size = sample_block_size
 
         self.transform_a = None
         self.transform_b = None
 
         self.demo_starts = None
         self.demo_ends = None
+        # guards the storage against a background sampler, see prefetch.py
+        self.lock = threading.Lock()
+
+        self.prioritized = prioritized
+        if prioritized:
+            # leaves hold priority ** alpha, new transitions get the max one
+            self.priorities = SumTree(capacity)
+            self.priority_alpha = priority_alpha
+            self.priority_beta = priority_beta
+            self.priority_eps = priority_eps
+
+        # per-camera features (e.g. DINOv2) of the obs and next_obs frames,
+        # computed by the agent when first needed, see store_features
+        self.feature_dim = feature_dim
+        if feature_dim:
+            feature_shape = (capacity, obs_shape[0] // 3, feature_dim)
+            self.obs_features = self._alloc("obs_features", feature_shape, np.float16)
+            self.next_obs_features = self._alloc(
+                "next_obs_features", feature_shape, np.float16
+            )
+            if storage == "device":
+                self.has_obs_features = np.zeros(capacity, dtype=bool)
+                self.has_next_obs_features = np.zeros(capacity, dtype=bool)
+            else:
+                self.has_obs_features = self._alloc(
+                    "has_obs_features", (capacity,), bool, False
+                )
+                self.has_next_obs_features = self._alloc(
+                    "has_next_obs_features", (capacity,), bool, False
+                )
+            # writes per slot, so that features computed outside the lock
+            # (e.g. by the background E2C refresh) are not stored for a
+            # rewritten slot
+            self.feature_writes = np.zeros(capacity, dtype=np.int64)
+
+        # per-slot cache of the agent's LaNE bonus terms, allocated on the
+        # first store_bonuses. A slot's entry is valid for the encoder version
+        # it was computed with, -1 once the slot is overwritten
+        self.bonus_versions = None
 
-        if load_dir != "None" and load_dir is not None:
+        if self.reopened:
+            with open(os.path.join(storage_dir, "meta.json")) as f:
+                meta = json.load(f)
+            assert meta["capacity"] == capacity
+            self.idx = meta["idx"]
+            self.last_save = meta["last_save"]
+            self.total_added = meta.get("total_added", 0)
+            self.full = meta["full"]
+            self.keep_loaded_end = meta["keep_loaded_end"]
+            self.demo_starts = meta["demo_starts"]
+            self.demo_ends = meta["demo_ends"]
+            if prioritized:
+                self.priorities.update(
+                    np.arange(self.capacity if self.full else self.idx), 1.0
+                )
+        elif load_dir != "None" and load_dir is not None:
             # self.load(load_dir)
-            self.load_from_modem_dataset(load_dir, n_demos)
+            if is_demo_dataset(load_dir):
+                self.load_demo_dataset(load_dir, n_demos)
+            else:
+                self.load_from_modem_dataset(load_dir, n_demos)
+
+    def _alloc(self, name, shape, dtype, fill=None):
+        if self.storage == "compressed" and len(shape) == 4 and dtype == np.uint8:
+            # only pixel frames are compressed, the rest stays in plain arrays
+            return CompressedFrames(shape, dtype, self.frame_codec, self.decode_threads)
+        if self.storage == "chunked" and shape[0] == self.capacity and fill is None:
+            # the per-transition fields grow with the data, see chunked_array.py
+            return ChunkedArray(shape, dtype)
+        if self.storage in ("memory", "compressed", "chunked"):
+            array = np.empty(shape, dtype=dtype)
+        elif self.storage == "device":
+            dtype = torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+            array = torch.empty(shape, dtype=dtype, device=self.device)
+        elif self.reopened and os.path.exists(
+            os.path.join(self.storage_dir, name + ".npy")
+        ):
+            array = np.load(
+                os.path.join(self.storage_dir, name + ".npy"), mmap_mode="r+"
+            )
+            # the frame pools (not sized by capacity) may have grown since
+            if shape[0] == self.capacity:
+                shape_ok = array.shape == tuple(shape)
+            else:
+                shape_ok = array.shape[1:] == tuple(shape[1:])
+                shape_ok = shape_ok and array.shape[0] >= shape[0]
+            if not shape_ok or array.dtype != np.dtype(dtype):
+                raise ValueError(
+                    "%s in %s is %s %s, the buffer needs %s %s: reopened with "
+                    "different obs/action shapes or options?"
+                    % (
+                        name + ".npy",
+                        self.storage_dir,
+                        array.dtype,
+                        array.shape,
+                        np.dtype(dtype),
+                        tuple(shape),
+                    )
+                )
+            return array
+        else:
+            array = np.lib.format.open_memmap(
+                os.path.join(self.storage_dir, name + ".npy"),
+                mode="w+",
+                dtype=dtype,
+                shape=shape,
+            )
+        if fill is not None and self.storage == "device":
+            array.fill_(fill)
+        elif fill is not None:
+            array.fill(fill)
+        return array
+
+    def _to_storage(self, x):
+        if self.storage != "device":
+            return x
+        return torch.as_tensor(x, device=self.device)
+
+    def _grow(self, name, array, size):
+        if isinstance(array, CompressedFrames):
+            array.resize(size)
+            return array
+        if self.storage != "memmap":
+            grown = np.empty((size, *array.shape[1:]), dtype=array.dtype)
+            grown[: len(array)] = array
+            return grown
+        # write the grown array next to the old one, then swap the files
+        path = os.path.join(self.storage_dir, name + ".npy")
+        grown = np.lib.format.open_memmap(
+            path + ".tmp", mode="w+", dtype=array.dtype, shape=(size, *array.shape[1:])
+        )
+        grown[: len(array)] = array
+        grown.flush()
+        os.replace(path + ".tmp", path)
+        return grown
 
     def add(self, obs, action, reward, next_obs, done):
-        np.copyto(self.obses[self.idx], obs)
-        np.copyto(self.actions[self.idx], action)
-        np.copyto(self.rewards[self.idx], reward)
-        np.copyto(self.next_obses[self.idx], next_obs)
-        np.copyto(self.not_dones[self.idx], not done)
+        with self.lock:
+            self._add(obs, action, reward, next_obs, done)
+
+    def add_batch(self, obses, actions, rewards, next_obses, dones):
+        """Add N transitions, row i coming from the i-th of N parallel envs.
+
+        Accepts numpy arrays or torch tensors. Each field is written with
+        one slice assignment per contiguous run of slots, and tensors stay
+        on the device for the device storage.
+        """
+        with self.lock:
+            self._add_batch(obses, actions, rewards, next_obses, dones)
+
+    def _add_batch(self, obses, actions, rewards, next_obses, dones):
+        n = len(obses)
+        if self.batch_last_slots is None or len(self.batch_last_slots) != n:
+            self.batch_last_slots = np.full(n, -1, dtype=np.int64)
+
+        if self.storage == "device":
+            obses, actions, rewards, next_obses, dones = [
+                self._to_storage(x)
+                for x in (obses, actions, rewards, next_obses, dones)
+            ]
+            not_dones = ~dones.bool().reshape(-1, 1)
+            done = dones.bool().reshape(-1).cpu().numpy()
+        else:
+            obses, actions, rewards, next_obses, dones = [
+                x.cpu().numpy() if isinstance(x, torch.Tensor) else np.asarray(x)
+                for x in (obses, actions, rewards, next_obses, dones)
+            ]
+            not_dones = ~dones.astype(bool).reshape(-1, 1)
+            done = ~not_dones[:, 0]
+        rewards = rewards.reshape(-1, 1)
+        if self.dedup_frames:
+            # frame links are per row anyway, add each env's transition in turn
+            for i in range(n):
+                self.last_slot = self.batch_last_slots[i]
+                self._add(obses[i], actions[i], rewards[i], next_obses[i], dones[i])
+                self.batch_last_slots[i] = self.last_slot
+            self.last_slot = -1
+            return
 
+        # link each env's transition to its previous one, before any overwrite
+        prevs = self.batch_last_slots
+        rows = np.flatnonzero(prevs >= 0)
+        rows = rows[self.next_slots[prevs[rows]] < 0]
+        if len(rows):
+            pending = self.next_obses[prevs[rows]]
+            current = obses[rows]
+            if self.storage == "device":
+                same = (pending == current).flatten(1).all(1).cpu().numpy()
+            else:
+                same = (pending == current).reshape(len(rows), -1).all(1)
+            rows = rows[same]
+        link_prevs = prevs[rows]
+
+        slots = np.empty(n, dtype=np.int64)
+        start = 0
+        while start < n:
+            count = min(n - start, self.capacity - self.idx)
+            end = start + count
+            self._release_range(self.idx, self.idx + count)
+            dst = slice(self.idx, self.idx + count)
+            self.obses[dst] = obses[start:end]
+            self.next_obses[dst] = next_obses[start:end]
+            self.actions[dst] = actions[start:end]
+            self.rewards[dst] = rewards[start:end]
+            self.not_dones[dst] = not_dones[start:end]
+            self._invalidate_caches(dst)
+            slots[start:end] = np.arange(self.idx, self.idx + count)
+            start = end
+            self.idx += count
+            if self.idx == self.capacity:
+                self.idx = self.keep_loaded_end if self.keep_loaded else 0
+                self.full = True
+
+        # a previous slot overwritten by this batch has nothing to link
+        keep = np.isin(link_prevs, slots, invert=True)
+        rows, link_prevs = rows[keep], link_prevs[keep]
+        self.next_slots[link_prevs] = slots[rows]
+        self.prev_slots[slots[rows]] = link_prevs
+        self.batch_last_slots = np.where(done, -1, slots)
+        self.last_slot = -1
+
+        if self.prioritized:
+            self.priorities.update(slots, self.priorities.max_priority)
+        self.total_added += n
+
+    def _release_range(self, start, end):
+        """Vectorized _release_slot for the slots [start, end) without frames."""
+        if self.dedup_frames:
+            for slot in range(start, end):
+                self._release_slot(slot)
+            return
+        slots = np.arange(start, end)
+        prevs = self.prev_slots[start:end]
+        mask = prevs >= 0
+        mask[mask] = self.next_slots[prevs[mask]] == slots[mask]
+        self.next_slots[prevs[mask]] = -1
+        nxts = self.next_slots[start:end]
+        mask = nxts >= 0
+        mask[mask] = self.prev_slots[nxts[mask]] == slots[mask]
+        self.prev_slots[nxts[mask]] = -1
+        self.next_slots[start:end] = -1
+        self.prev_slots[start:end] = -1
+
+    def _add(self, obs, action, reward, next_obs, done):
+        slot = self.idx
+        continues = self._continues(obs)
+        self._release_slot(slot)
+        if self.storage == "device":
+            self.obses[slot] = self._to_storage(obs)
+            self.actions[slot] = self._to_storage(action)
+            self.rewards[slot] = float(reward)
+            self.next_obses[slot] = self._to_storage(next_obs)
+            self.not_dones[slot] = not done
+        else:
+            self.obses[slot] = obs[-self.frame_channels :]
+            if not self.dedup_frames:
+                self.next_obses[slot] = next_obs
+            self.actions[slot] = action
+            self.rewards[slot] = reward
+            self.not_dones[slot] = not done
+        self._invalidate_caches(slot)
+
+        if continues:
+            if self.dedup_frames:
+                # obs is the pending next_obs of the previous transition, keep it once
+                self._free_terminal(self.last_slot)
+            self.next_slots[self.last_slot] = slot
+            self.prev_slots[slot] = self.last_slot
+        elif self.frame_stack > 1:
+            self._set_head(slot, obs[: -self.frame_channels])
+        if self.dedup_frames:
+            self.terminal_slots[slot] = self._store_terminal(
+                next_obs[-self.frame_channels :]
+            )
+        elif self.storage == "device":
+            self.last_next_obs = np.array(next_obs)
+        self.last_slot = slot if not done else -1
+
+        if self.prioritized:
+            self.priorities.update(slot, self.priorities.max_priority)
+        self.total_added += 1
         if not self.keep_loaded:
             self.idx = (self.idx + 1) % self.capacity
             self.full = self.full or self.idx == 0
@@ -108,6 +535,189 @@ class ReplayBuffer(Dataset):
                 self.idx = self.keep_loaded_end
                 self.full = True
 
+    def _continues(self, obs):
+        """Whether obs continues the episode of the last added transition."""
+        prev = self.last_slot
+        if prev < 0 or prev == self.idx or self.next_slots[prev] >= 0:
+            return False
+        if self.frame_stack > 1:
+            # compare the newest frame first, the whole stack only if it matches
+            pending = self.terminal_obses[self.terminal_slots[prev]]
+            return np.array_equal(
+                pending, obs[-self.frame_channels :]
+            ) and np.array_equal(self.get_next_obses(prev), obs)
+        if self.dedup_frames:
+            pending = self.terminal_obses[self.terminal_slots[prev]]
+        elif self.storage == "device":
+            pending = self.last_next_obs
+        else:
+            pending = self.next_obses[prev]
+        return np.array_equal(pending, obs)
+
+    def _release_slot(self, slot):
+        """Unlink a slot from its episode before it gets overwritten."""
+        nxt = self.next_slots[slot]
+        if self.frame_stack > 1:
+            if nxt >= 0 and self.prev_slots[nxt] == slot:
+                # the successor's stack still starts with frames up to this slot
+                self._set_head(nxt, self.get_obses(slot)[self.frame_channels :])
+            if self.head_slots[slot] >= 0:
+                self.free_heads.append(self.head_slots[slot])
+            self.head_slots[slot] = -1
+        if self.dedup_frames and self.terminal_slots[slot] >= 0:
+            self._free_terminal(slot)
+        prev = self.prev_slots[slot]
+        if prev >= 0 and self.next_slots[prev] == slot:
+            if self.dedup_frames:
+                # the predecessor still reads its next_obs from this slot
+                self.terminal_slots[prev] = self._store_terminal(self.obses[slot])
+            self.next_slots[prev] = -1
+        if nxt >= 0 and self.prev_slots[nxt] == slot:
+            self.prev_slots[nxt] = -1
+        self.next_slots[slot] = -1
+        self.prev_slots[slot] = -1
+
+    def _link(self, prev, slot):
+        """Make slot follow prev in its episode, both written as episode ends
+        and starts, e.g. by separate _write_range calls."""
+        if self.dedup_frames and self.terminal_slots[prev] >= 0:
+            # prev now reads its next_obs from slot
+            self._free_terminal(prev)
+        if self.frame_stack > 1:
+            # and slot its older frames from prev
+            if self.head_slots[slot] >= 0:
+                self.free_heads.append(self.head_slots[slot])
+            self.head_slots[slot] = -1
+        self.next_slots[prev] = slot
+        self.prev_slots[slot] = prev
+
+    def _store_terminal(self, frame):
+        if not self.free_terminals:
+            size = len(self.terminal_obses)
+            self.terminal_obses = self._grow(
+                "terminal_obses", self.terminal_obses, 2 * size
+            )
+            self.free_terminals = list(range(2 * size - 1, size - 1, -1))
+        terminal = self.free_terminals.pop()
+        self.terminal_obses[terminal] = frame
+        return terminal
+
+    def _free_terminal(self, slot):
+        self.free_terminals.append(self.terminal_slots[slot])
+        self.terminal_slots[slot] = -1
+
+    def _set_head(self, slot, head):
+        """Keep the k - 1 frames stacked before the slot's frame."""
+        head = np.asarray(head).reshape(self.frame_stack - 1, *self.obses.shape[1:])
+        frame = self.obses[slot]
+        if all(np.array_equal(older, frame) for older in head):
+            self.head_slots[slot] = -2
+            return
+        if not self.free_heads:
+            size = len(self.head_obses)
+            self.head_obses = self._grow("head_obses", self.head_obses, 2 * size)
+            self.free_heads = list(range(2 * size - 1, size - 1, -1))
+        self.head_slots[slot] = self.free_heads.pop()
+        self.head_obses[self.head_slots[slot]] = head
+
+    def _as_idxes(self, idxes):
+        if isinstance(idxes, slice):
+            idxes = np.arange(*idxes.indices(self.capacity))
+        return np.asarray(idxes)
+
+    def get_obses(self, idxes):
+        if self.frame_stack == 1:
+            return self.obses[idxes]
+        idxes = self._as_idxes(idxes)
+        if idxes.ndim == 0:
+            return self.get_obses(idxes[None])[0]
+
+        # walk back the episode for the older frames, then into the head
+        k = self.frame_stack
+        stack = np.empty((len(idxes), k, *self.obses.shape[1:]), self.obses.dtype)
+        stack[:, -1] = self.obses[idxes]
+        slots = idxes.copy()
+        walking = np.ones(len(idxes), dtype=bool)
+        past_start = np.zeros(len(idxes), dtype=np.int64)
+        for d in range(1, k):
+            prev = np.where(walking, self.prev_slots[slots], -1)
+            walking = prev >= 0
+            slots = np.where(walking, prev, slots)
+            past_start += ~walking
+            if walking.any():
+                stack[walking, k - 1 - d] = self.obses[slots[walking]]
+            rows = np.flatnonzero(~walking)
+            if len(rows):
+                heads = self.head_slots[slots[rows]]
+                repeat = heads < 0
+                stack[rows[repeat], k - 1 - d] = self.obses[slots[rows[repeat]]]
+                rows, heads = rows[~repeat], heads[~repeat]
+                stack[rows, k - 1 - d] = self.head_obses[
+                    heads, k - 1 - past_start[rows]
+                ]
+        return stack.reshape(len(idxes), -1, *self.obses.shape[2:])
+
+    def get_next_obses(self, idxes, obses=None):
+        """obses can pass the already gathered get_obses(idxes)."""
+        if not self.dedup_frames:
+            return self.next_obses[idxes]
+        idxes = self._as_idxes(idxes)
+        if idxes.ndim == 0:
+            return self.get_next_obses(idxes[None])[0]
+
+        next_slots = self.next_slots[idxes]
+        next_obses = self.obses[np.maximum(next_slots, 0)]
+        terminal = next_slots < 0
+        if terminal.any():
+            next_obses[terminal] = self.terminal_obses[
+                self.terminal_slots[idxes[terminal]]
+            ]
+        if self.frame_stack > 1:
+            if obses is None:
+                obses = self.get_obses(idxes)
+            next_obses = np.concatenate(
+                [obses[:, self.frame_channels :], next_obses], axis=1
+            )
+        return next_obses
+
+    def _write_range(self, start, obses, next_obses, actions, rewards, not_dones):
+        end = start + len(obses)
+        for slot in range(start, end):
+            self._release_slot(slot)
+        if not self.dedup_frames:
+            self.next_obses[start:end] = self._to_storage(next_obses)
+        self.obses[start:end] = self._to_storage(obses[:, -self.frame_channels :])
+        self.actions[start:end] = self._to_storage(actions)
+        self.rewards[start:end] = self._to_storage(rewards)
+        self.not_dones[start:end] = self._to_storage(not_dones)
+        self._invalidate_caches(slice(start, end))
+        if self.prioritized:
+            self.priorities.update(
+                np.arange(start, end), self.priorities.max_priority
+            )
+        self.last_slot = -1
+        if len(obses) == 0:
+            return
+
+        # a transition links to the next one if its next_obs is that obs
+        links = np.asarray(not_dones[:-1]).reshape(-1).astype(bool)
+        frame_shape = (len(obses) - 1, int(np.prod(obses.shape[1:])))
+        links &= (
+            np.asarray(next_obses[:-1]).reshape(frame_shape)
+            == np.asarray(obses[1:]).reshape(frame_shape)
+        ).all(axis=1)
+        linked = np.flatnonzero(links) + start
+        self.next_slots[linked] = linked + 1
+        self.prev_slots[linked + 1] = linked
+        if self.frame_stack > 1:
+            for i in np.flatnonzero(np.insert(~links, 0, True)):
+                self._set_head(start + i, obses[i][: -self.frame_channels])
+        if self.dedup_frames:
+            for i in np.flatnonzero(np.append(~links, True)):
+                self.terminal_slots[start + i] = self._store_terminal(
+                    next_obses[i][-self.frame_channels :]
+                )
+
     def create_tensors(self, obses, next_obses, actions, rewards, not_dones):
         obses = torch.as_tensor(obses, device=self.device).float()
         next_obses = torch.as_tensor(next_obses, device=self.device).float()
@@ -116,44 +726,272 @@ class ReplayBuffer(Dataset):
         not_dones = torch.as_tensor(not_dones, device=self.device)
         return obses, actions, rewards, next_obses, not_dones
 
-    def sample_proprio(self):
-        idxes = np.random.randint(
-            0, self.capacity if self.full else self.idx, size=self.batch_size
-        )
+    def _randint(self, low, high, size):
+        if self.storage == "device":
+            # keep index generation on the device holding the storage
+            return torch.randint(low, high, (size,), device=self.device)
+        return np.random.randint(low, high, size=size)
 
-        return self.create_tensors(
-            self.obses[idxes],
-            self.next_obses[idxes],
-            self.actions[idxes],
-            self.rewards[idxes],
-            self.not_dones[idxes],
-        )
+    def _sample_range(self, low, high, size):
+        if self.sample_blocks == 0 or size == 0:
+            return self._randint(low, high, size)
+        # fewer, longer blocks read more contiguous memory but give more
+        # correlated batches
+        block_size = min(self.sample_block_size, high - low)
+        num_blocks = min(self.sample_blocks, size)
+        starts = self._randint(low, high - block_size + 1, num_blocks)
+        blocks = self._randint(0, num_blocks, size)
+        return starts[blocks] + self._randint(0, block_size, size)
+
+    def _sample_ranges(self, demo_density=None):
+        """The (low, high, batch size) ranges a batch is drawn from."""
+        if demo_density is None:
+            return [(0, self.capacity if self.full else self.idx, self.batch_size)]
+
+        assert demo_density <= 1
+        assert demo_density >= 0
+        demo_batch_size = int(self.batch_size * demo_density)
+        exp_batch_size = self.batch_size - demo_batch_size
+        exp_end = self.capacity if self.full else self.idx
+        if exp_end * demo_density < self.keep_loaded_end:
+            exp_sample_start = 0
+        else:
+            exp_sample_start = self.keep_loaded_end
+        return [
+            (0, self.keep_loaded_end, demo_batch_size),
+            (exp_sample_start, exp_end, exp_batch_size),
+        ]
 
-    def sample_rad(self, aug_funcs, demo_density=None):
-        if demo_density is not None:
-            assert demo_density <= 1
-            assert demo_density >= 0
-            demo_batch_size = int(self.batch_size * demo_density)
-            exp_batch_size = self.batch_size - demo_batch_size
-            demo_idxes = np.random.randint(
-                0, self.keep_loaded_end, size=demo_batch_size
+    def _sample_idxes(self, demo_density=None):
+        ranges = self._sample_ranges(demo_density)
+        if self.prioritized:
+            return self._sample_prioritized(ranges)[0]
+        idxes = [self._sample_range(low, high, size) for low, high, size in ranges]
+        if len(idxes) == 1:
+            return idxes[0]
+        if self.storage == "device":
+            return torch.cat(idxes)
+        return np.concatenate(idxes)
+
+    def _sample_prioritized(self, ranges):
+        """Sample each range by priority, with importance sampling weights."""
+        idxes, probs = [], []
+        for low, high, size in ranges:
+            if size == 0:
+                continue
+            range_idxes, range_probs = self.priorities.sample(low, high, size)
+            idxes.append(range_idxes)
+            probs.append(range_probs * size / self.batch_size)
+        idxes = np.concatenate(idxes)
+        num_valid = self.capacity if self.full else self.idx
+        weights = (num_valid * np.concatenate(probs)) ** -self.priority_beta
+        weights = (weights / weights.max()).astype(np.float32)[:, None]
+        if self.storage == "device":
+            idxes = torch.as_tensor(idxes, device=self.device)
+        return idxes, weights
+
+    def update_priorities(self, idxes, td_errors):
+        idxes = torch.as_tensor(idxes).cpu().numpy()
+        td_errors = torch.as_tensor(td_errors).detach().cpu().numpy().reshape(-1)
+        priorities = (np.abs(td_errors) + self.priority_eps) ** self.priority_alpha
+        with self.lock:
+            self.priorities.update(idxes, priorities)
+            self.priorities.max_priority = max(
+                self.priorities.max_priority, priorities.max()
             )
-            exp_end = self.capacity if self.full else self.idx
-            if exp_end * demo_density < self.keep_loaded_end:
-                exp_sample_start = 0
+
+    def _episode_slots(self, idxes):
+        """The n_step slots from each of idxes on, repeating the last one past
+        the end of its episode, and whether each is still in the episode."""
+        # follow the episode links one step at a time for the whole batch
+        host_idxes = torch.as_tensor(idxes).cpu().numpy()
+        slots = np.empty((len(host_idxes), self.n_step), dtype=np.int64)
+        valid = np.zeros((len(host_idxes), self.n_step), dtype=bool)
+        slots[:, 0] = host_idxes
+        valid[:, 0] = True
+        for k in range(1, self.n_step):
+            nxt = self.next_slots[slots[:, k - 1]]
+            valid[:, k] = valid[:, k - 1] & (nxt >= 0)
+            slots[:, k] = np.where(valid[:, k], nxt, slots[:, k - 1])
+        return slots, valid
+
+    def bonus_slots(self, idxes):
+        """The (len(idxes), n_step) slots whose next_obs are the states reached
+        by the transitions sampled at idxes, and the discount of each step,
+        0 past the end of the episode, as _gather discounts the rewards."""
+        if self.n_step == 1:
+            slots = torch.as_tensor(idxes).cpu().numpy()[:, None]
+            return slots, np.ones(slots.shape, dtype=np.float32)
+        slots, valid = self._episode_slots(idxes)
+        discounts = (self.discount ** np.arange(self.n_step)) * valid
+        return slots, discounts.astype(np.float32)
+
+    def _invalidate_caches(self, slots):
+        """Forget what was computed from the overwritten slots."""
+        if self.bonus_versions is not None:
+            self.bonus_versions[slots] = -1
+        if self.feature_dim:
+            self.has_obs_features[slots] = False
+            self.has_next_obs_features[slots] = False
+            self.feature_writes[slots] += 1
+
+    def missing_feature_frames(self, slots, next_obs=False):
+        """The distinct slots among slots whose obs (next_obs) has no features,
+        their obs (next_obs) frames and their write counts for store_features."""
+        slots = np.unique(torch.as_tensor(slots).cpu().numpy())
+        has = self.has_next_obs_features if next_obs else self.has_obs_features
+        with self.lock:
+            slots = slots[~has[slots]]
+            frames = (self.get_next_obses if next_obs else self.get_obses)(slots)
+            writes = self.feature_writes[slots].copy()
+        return slots, frames, writes
+
+    def store_features(self, slots, features, writes, next_obs=False):
+        """Store the (len(slots), n_cams * feature_dim) features of the obs
+        (next_obs) frames of slots, read with missing_feature_frames, except
+        for the slots written since."""
+        features = features.reshape(len(slots), -1, self.feature_dim).half()
+        with self.lock:
+            kept = self.feature_writes[slots] == writes
+            slots = slots[kept]
+            features = features[torch.as_tensor(kept, device=features.device)]
+            if self.storage != "device":
+                features = features.cpu().numpy()
+            if next_obs:
+                # the next_obs of a transition is the obs of the following one
+                stores = (self.next_obs_features, self.has_next_obs_features)
+                linked_stores = (self.obs_features, self.has_obs_features)
+                linked = self.next_slots[slots]
             else:
-                exp_sample_start = self.keep_loaded_end
-            exp_idxes = np.random.randint(
-                exp_sample_start, exp_end, size=exp_batch_size
-            )
-            idxes = np.concatenate([demo_idxes, exp_idxes])
-        else:
-            idxes = np.random.randint(
-                0, self.capacity if self.full else self.idx, size=self.batch_size
+                stores = (self.obs_features, self.has_obs_features)
+                linked_stores = (self.next_obs_features, self.has_next_obs_features)
+                linked = self.prev_slots[slots]
+            rows = np.flatnonzero(linked >= 0)
+            stores[0][slots] = features
+            stores[1][slots] = True
+            linked_stores[0][linked[rows]] = features[rows]
+            linked_stores[1][linked[rows]] = True
+
+    def get_features(self, slots, next_obs=False):
+        """The stored features of the obs (next_obs) of slots, as a float32
+        (len(slots), n_cams * feature_dim) device tensor."""
+        with self.lock:
+            features = (self.next_obs_features if next_obs else self.obs_features)[
+                slots
+            ]
+        return torch.as_tensor(features, device=self.device).float().flatten(1)
+
+    def get_e2c_features(self, idxes):
+        """(obs features, actions, next_obs features) of the idxes whose obs
+        and next_obs both have features, read together under the lock."""
+        idxes = torch.as_tensor(idxes).cpu().numpy()
+        with self.lock:
+            has_both = self.has_obs_features[idxes] & self.has_next_obs_features[idxes]
+            idxes = idxes[has_both]
+            obs_features = self.obs_features[idxes]
+            actions = self.actions[idxes]
+            next_obs_features = self.next_obs_features[idxes]
+        obs_features, actions, next_obs_features = [
+            torch.as_tensor(x, device=self.device).float()
+            for x in (obs_features, actions, next_obs_features)
+        ]
+        return obs_features.flatten(1), actions, next_obs_features.flatten(1)
+
+    def stale_bonus_slots(self, slots, version):
+        """The distinct slots among slots without a cached bonus of version."""
+        slots = np.unique(slots)
+        if self.bonus_versions is None:
+            return slots
+        return slots[self.bonus_versions[slots] != version]
+
+    def store_bonuses(self, slots, version, dists, discount_powers):
+        """Cache the nearest demo distance and discount power of the bonus
+        latents of slots, computed with encoder version."""
+        with self.lock:
+            if self.bonus_versions is None:
+                # derived from the encoder, so kept in memory and never saved
+                self.bonus_versions = np.full(self.capacity, -1, dtype=np.int64)
+                if self.storage == "device":
+                    self.bonus_dists = torch.empty(self.capacity, device=self.device)
+                    self.bonus_powers = torch.empty(
+                        self.capacity, dtype=torch.long, device=self.device
+                    )
+                else:
+                    self.bonus_dists = np.empty(self.capacity, dtype=np.float32)
+                    self.bonus_powers = np.empty(self.capacity, dtype=np.int64)
+            if self.storage != "device":
+                dists, discount_powers = [
+                    x.cpu().numpy() for x in (dists, discount_powers)
+                ]
+            self.bonus_dists[slots] = dists
+            self.bonus_powers[slots] = discount_powers
+            self.bonus_versions[slots] = version
+
+    def get_bonuses(self, slots):
+        """The cached (dists, discount powers) of slots, as device tensors."""
+        with self.lock:
+            dists = self.bonus_dists[slots]
+            discount_powers = self.bonus_powers[slots]
+        return (
+            torch.as_tensor(dists, device=self.device),
+            torch.as_tensor(discount_powers, device=self.device),
+        )
+
+    def _gather(self, idxes):
+        """The (n-step) transitions starting at idxes."""
+        obses = self.get_obses(idxes)
+        if self.n_step == 1:
+            return (
+                obses,
+                self.get_next_obses(idxes, obses),
+                self.actions[idxes],
+                self.rewards[idxes],
+                self.not_dones[idxes],
             )
 
-        obses = self.obses[idxes]
-        next_obses = self.next_obses[idxes]
+        slots, valid = self._episode_slots(idxes)
+        last = slots[:, -1]
+        discounts = (self.discount ** np.arange(self.n_step)) * valid
+        # target = reward + not_done * discount * V bootstraps with discount ** m
+        bootstrap = self.discount ** (valid.sum(axis=1, keepdims=True) - 1)
+        if self.storage == "device":
+            last = torch.as_tensor(last, device=self.device)
+            slots = torch.as_tensor(slots, device=self.device)
+        rewards = (
+            self.rewards[slots][..., 0] * self._to_storage(discounts.astype(np.float32))
+        ).sum(1)[:, None]
+        not_dones = self.not_dones[last] * self._to_storage(
+            bootstrap.astype(np.float32)
+        )
+        return (
+            obses,
+            self.get_next_obses(last),
+            self.actions[idxes],
+            rewards,
+            not_dones,
+        )
+
+    def sample_proprio(self):
+        idxes = self._sample_idxes()
+
+        obses, next_obses, actions, rewards, not_dones = self._gather(idxes)
+        return self.create_tensors(obses, next_obses, actions, rewards, not_dones)
+
+    def sample_rad_arrays(self, aug_funcs, demo_density=None, return_idxes=False):
+        """Sample a batch and apply the array augs, without tensor conversion.
+
+        With return_idxes, the sampled indexes and their importance sampling
+        weights (ones unless prioritized) are appended to the batch.
+        """
+        with self.lock:
+            if self.prioritized:
+                idxes, weights = self._sample_prioritized(
+                    self._sample_ranges(demo_density)
+                )
+            else:
+                idxes = self._sample_idxes(demo_density)
+                weights = None
+            obses, next_obses, actions, rewards, not_dones = self._gather(idxes)
 
         if aug_funcs:
             for aug, func in aug_funcs.items():
@@ -166,17 +1004,13 @@ class ReplayBuffer(Dataset):
                     obses, tw, th = func(obses)
                     next_obses, _, _ = func(next_obses, tw, th)
 
-        obses, actions, rewards, next_obses, not_dones = self.create_tensors(
-            obses,
-            next_obses,
-            self.actions[idxes],
-            self.rewards[idxes],
-            self.not_dones[idxes],
-        )
-
-        obses = obses / 255.0
-        next_obses = next_obses / 255.0
+        if return_idxes:
+            if weights is None:
+                weights = np.ones((len(idxes), 1), dtype=np.float32)
+            return obses, actions, rewards, next_obses, not_dones, idxes, weights
+        return obses, actions, rewards, next_obses, not_dones
 
+    def apply_tensor_augs(self, aug_funcs, obses, next_obses):
         # augmentations go here
         if aug_funcs:
             for aug, func in aug_funcs.items():
@@ -185,16 +1019,53 @@ class ReplayBuffer(Dataset):
                     continue
                 obses = func(obses)
                 next_obses = func(next_obses)
+        return obses, next_obses
+
+    def sample_rad(self, aug_funcs, demo_density=None, return_idxes=False):
+        batch = self.sample_rad_arrays(aug_funcs, demo_density, return_idxes)
+        obses, actions, rewards, next_obses, not_dones = batch[:5]
+
+        obses, actions, rewards, next_obses, not_dones = self.create_tensors(
+            obses, next_obses, actions, rewards, not_dones
+        )
 
+        obses = obses / 255.0
+        next_obses = next_obses / 255.0
+
+        obses, next_obses = self.apply_tensor_augs(aug_funcs, obses, next_obses)
+        if return_idxes:
+            weights = torch.as_tensor(batch[6], device=self.device)
+            return obses, actions, rewards, next_obses, not_dones, batch[5], weights
         return obses, actions, rewards, next_obses, not_dones
 
-    def sample_e2c(self):
-        idxes = np.random.randint(
-            0, self.capacity if self.full else self.idx+1, size=self.batch_size
+    def recent_idxes(self, size, window):
+        """size random slots among the window last added ones."""
+        if not self.full:
+            window = min(window, self.idx)
+            return self.idx - np.random.randint(1, window + 1, size=size)
+        # the ring wraps back to wrap_start
+        wrap_start = self.keep_loaded_end if self.keep_loaded else 0
+        window = min(window, self.capacity - wrap_start)
+        slots = self.idx - np.random.randint(1, window + 1, size=size)
+        slots[slots < wrap_start] += self.capacity - wrap_start
+        return slots
+
+    def sample_e2c_idxes(self):
+        return self._randint(
+            0, self.capacity if self.full else self.idx+1, self.batch_size
         )
 
-        obs_non_crop = self.obses[idxes]
-        next_obs_non_crop = self.next_obses[idxes]
+    def sample_e2c(self, idxes=None):
+        # the E2C model may be trained in the background, see e2c_trainer.py
+        with self.lock:
+            if idxes is None:
+                idxes = self.sample_e2c_idxes()
+
+            obs_non_crop = self.get_obses(idxes)
+            next_obs_non_crop = self.get_next_obses(idxes)
+            actions = self.actions[idxes]
+            rewards = self.rewards[idxes]
+            not_dones = self.not_dones[idxes]
 
         obses = random_crop(obs_non_crop)
         next_obses = random_crop(next_obs_non_crop)
@@ -202,9 +1073,9 @@ class ReplayBuffer(Dataset):
         obses, actions, rewards, next_obses, not_dones = self.create_tensors(
             obses,
             next_obses,
-            self.actions[idxes],
-            self.rewards[idxes],
-            self.not_dones[idxes],
+            actions,
+            rewards,
+            not_dones,
         )
 
         obses = obses / 255.0
@@ -217,17 +1088,47 @@ class ReplayBuffer(Dataset):
 
         return obses, actions, next_obses, obs_non_crop, next_obs_non_crop
 
+    def checkpoint(self):
+        """Flush the memmap files and record where the buffer stands."""
+        for array in vars(self).values():
+            if isinstance(array, np.memmap):
+                array.flush()
+        meta = {
+            "capacity": self.capacity,
+            "idx": self.idx,
+            "last_save": self.last_save,
+            "total_added": self.total_added,
+            "full": self.full,
+            "keep_loaded_end": self.keep_loaded_end,
+            "demo_starts": (
+                None if self.demo_starts is None else list(map(int, self.demo_starts))
+            ),
+            "demo_ends": (
+                None if self.demo_ends is None else list(map(int, self.demo_ends))
+            ),
+        }
+        path = os.path.join(self.storage_dir, "meta.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+
     def save(self, save_dir):
+        if self.storage == "memmap":
+            # the memmap files already are the saved buffer
+            self.checkpoint()
+            return
         if self.idx == self.last_save:
             return
         path = os.path.join(save_dir, "%d_%d.pt" % (self.last_save, self.idx))
         payload = [
-            self.obses[self.last_save : self.idx],
-            self.next_obses[self.last_save : self.idx],
+            self.get_obses(slice(self.last_save, self.idx)),
+            self.get_next_obses(slice(self.last_save, self.idx)),
             self.actions[self.last_save : self.idx],
             self.rewards[self.last_save : self.idx],
             self.not_dones[self.last_save : self.idx],
         ]
+        if self.storage == "device":
+            payload = [x.cpu().numpy() for x in payload]
         self.last_save = self.idx
         torch.save(payload, path)
 
@@ -250,17 +1151,40 @@ class ReplayBuffer(Dataset):
 
         for traj in trajectories:
             start,end = end, end+len(traj['rewards'][1:])
-            self.obses[start:end] = stack_observations(traj['next_observations'][:-1])
-            self.next_obses[start:end] = stack_observations(traj['next_observations'][1:])
-            self.actions[start:end] = torch.stack(traj['actions'][1:]).numpy()
-            self.rewards[start:end] = torch.stack(traj['rewards'][1:]).unsqueeze(1).numpy()
-            self.not_dones[start:end] = [[True]] * (end-start-1) + [[False]]
+            self._write_range(
+                start,
+                stack_observations(traj['next_observations'][:-1]),
+                stack_observations(traj['next_observations'][1:]),
+                torch.stack(traj['actions'][1:]).numpy(),
+                torch.stack(traj['rewards'][1:]).unsqueeze(1).numpy(),
+                [[True]] * (end-start-1) + [[False]],
+            )
+            self.idx = end
+            self.keep_loaded_end = end
+            self.demo_starts.append(start)
+            self.demo_ends.append(end)
+
+    def load_demo_dataset(self, path, num_traj=10):
+        """Like load_from_modem_dataset, for a dataset made by demo_dataset.py.
+
+        Only the selected trajectories are read from the memory-mapped files.
+        """
+        dataset = DemoDataset(path)
+        # None loads every trajectory, like the slice of load_from_modem_dataset
+        n = len(dataset) if num_traj is None else min(num_traj, len(dataset))
+        selected = random.sample(range(len(dataset)), n)
+
+        self.demo_starts = []
+        self.demo_ends = []
+        end = 0
+        for i in selected:
+            start, end = end, end + dataset.num_transitions(i)
+            self._write_range(start, *dataset.trajectory(i))
             self.idx = end
             self.keep_loaded_end = end
             self.demo_starts.append(start)
             self.demo_ends.append(end)
 
-    
     def load(self, save_dir):
         chunks = os.listdir(save_dir)
         chunks = [c for c in chunks if c[-3:] == ".pt"]
@@ -270,11 +1194,9 @@ class ReplayBuffer(Dataset):
             path = os.path.join(save_dir, chunk)
             payload = torch.load(path)
             assert self.idx == start
-            self.obses[start:end] = payload[0]
-            self.next_obses[start:end] = payload[1]
-            self.actions[start:end] = payload[2]
-            self.rewards[start:end] = payload[3]
-            self.not_dones[start:end] = payload[4]
+            self._write_range(
+                start, payload[0], payload[1], payload[2], payload[3], payload[4]
+            )
             self.idx = end
             self.keep_loaded_end = end
         self.demo_starts = np.load(os.path.join(save_dir, "demo_starts.npy"))
@@ -283,10 +1205,10 @@ class ReplayBuffer(Dataset):
     def __getitem__(self, idx):
         idx = np.random.randint(0, self.capacity if self.full else self.idx, size=1)
         idx = idx[0]
-        obs = self.obses[idx]
+        obs = self.get_obses(idx)
         action = self.actions[idx]
         reward = self.rewards[idx]
-        next_obs = self.next_obses[idx]
+        next_obs = self.get_next_obses(idx)
         not_done = self.not_dones[idx]
 
         if self.transform:
@@ -371,3 +1293,42 @@ def create_mlp(in_features, out_features, n_hidden_layers=3, hidden_size=512):
         ]
     ff_layers.append(nn.Linear(in_features=hidden_size, out_features=out_features))
     return nn.Sequential(*ff_layers)
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    # gather bandwidth of random vs blocked batches from a large pixel buffer
+    capacity, batch_size = 20000, 128
+    for storage in ("memory", "memmap"):
+        with tempfile.TemporaryDirectory() as storage_dir:
+            buffer = ReplayBuffer(
+                (6, 128, 128),
+                (7,),
+                capacity,
+                batch_size,
+                "cpu",
+                0,
+                storage=storage,
+                storage_dir=storage_dir,
+            )
+            frames = np.random.randint(0, 256, (1000, 6, 128, 128), dtype=np.uint8)
+            for start in range(0, capacity, len(frames)):
+                buffer.obses[start : start + len(frames)] = frames
+                buffer.next_obses[start : start + len(frames)] = frames
+            buffer.idx, buffer.full = 0, True
+
+            for sample_blocks in (0, 16, 4, 1):
+                buffer.sample_blocks = sample_blocks
+                time_start = time.time()
+                for _ in range(50):
+                    idxes = buffer._sample_idxes()
+                    buffer.obses[idxes], buffer.get_next_obses(idxes)
+                elapsed = (time.time() - time_start) / 50
+                gigabytes = 2 * batch_size * frames[0].nbytes / 1e9
+                mode = "random" if sample_blocks == 0 else f"{sample_blocks} blocks"
+                print(
+                    f"{storage:7s} {mode:10s} | {elapsed * 1000:6.2f} ms/batch, "
+                    f"{gigabytes / elapsed:5.2f} GB/s"
+                )